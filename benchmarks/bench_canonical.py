@@ -0,0 +1,65 @@
+"""Replay a synthetic access log and compare hit rates with and without the
+canonical level cache.
+
+The log draws terrains from a Zipf distribution, as if some permalinks were
+shared much more widely than others, and each request spells its terrain in
+one of several equivalent ways: reordered, shifted, or with float heights.
+
+Run from the repository root with `python -m benchmarks.bench_canonical`.
+"""
+
+import asyncio
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+from water_filling import database
+
+rng = np.random.default_rng(0)
+
+
+def access_log(requests=20_000, terrains=2_000, size=64):
+    """Yield `(heights, volume)` for each request of the log."""
+    bases = [rng.integers(0, 21, size=size) for _ in range(terrains)]
+    volumes = rng.integers(0, 20 * size, size=terrains)
+    for i in (rng.zipf(1.2, size=requests) - 1) % terrains:
+        heights = bases[i]
+        match rng.integers(4):
+            case 0:
+                pass
+            case 1:
+                heights = rng.permutation(heights)
+            case 2:
+                heights = heights + rng.integers(-10, 11)
+            case 3:
+                heights = heights.astype(np.float64)
+        yield heights, np.int_(volumes[i])
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = Path(tmp) / "bench.cache.db"
+        database.con = database.connect(db_path)
+        # No lingering, as each request waits for the previous one's writes
+        database.writer = database.Writer(db_path, linger=0)
+        database.readers = database.Readers(db_path)
+        database.memory = database.MemoryCache(0)
+        requests = 0
+        for heights, volume in access_log():
+            await database.fulfill_as_json_serializable_with_cache_async(
+                heights, volume, False
+            )
+            database.writer.flush()
+            requests += 1
+        database.close()
+
+    exact = database.disk_stats["hits"]
+    canonical = exact + database.level_stats["hits"]
+    print(f"{requests} requests")
+    print(f"    exact key hit rate: {exact / requests:6.1%}")
+    print(f"canonical key hit rate: {canonical / requests:6.1%}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+"""Compare the cache codecs by compression ratio and decode latency.
+
+Run from the repository root with `python -m benchmarks.bench_compression`.
+"""
+
+import functools
+import timeit
+
+import numpy as np
+
+from water_filling import database, numerics, render
+
+rng = np.random.default_rng(0)
+
+
+def main(sizes=(20, 1000, 2**16 - 1)):
+    for size in sizes:
+        heights = rng.integers(0, 21, size=size)
+        level = numerics.level(heights, size * 5)
+        svg_data = render.render_svg(heights, level)
+        print(f"{size} heights, {len(svg_data)} bytes of SVG:")
+        for codec in database.codecs:
+            svg_encoded = database.encode_svg(svg_data, codec)
+            encode = functools.partial(database.encode_svg, svg_data, codec)
+            decode = functools.partial(database.decode_svg, svg_encoded, codec)
+            encode = min(timeit.repeat(encode, number=10, repeat=3))
+            decode = min(timeit.repeat(decode, number=10, repeat=3))
+            print(
+                f"{codec:>10}: ratio {len(svg_data) / len(svg_encoded):5.1f}x, "
+                f"encode {encode / 10 * 1e3:7.3f} ms, decode {decode / 10 * 1e3:7.3f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
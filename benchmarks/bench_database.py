@@ -0,0 +1,49 @@
+"""Time cache lookups by key as the number of rows in the cache grows.
+
+Run from the repository root with `python -m benchmarks.bench_database`.
+"""
+
+import tempfile
+import timeit
+from pathlib import Path
+
+import numpy as np
+
+from water_filling import database
+
+rng = np.random.default_rng(0)
+
+
+def fill(con, start, stop):
+    """Insert rows with small random instances numbered `start` to `stop`."""
+    keys = []
+    with con:
+        for i in range(start, stop):
+            heights = rng.integers(0, 21, size=16)
+            volume = np.int_(i)
+            keys.append(database.digest(heights, volume))
+            database._insert(con, keys[-1], heights, volume, 0.0, "<svg/>")
+    return keys
+
+
+def main(sizes=(10**3, 10**4, 10**5, 10**6), lookups=10_000):
+    with tempfile.TemporaryDirectory() as tmp:
+        con = database.connect(Path(tmp) / "bench.cache.db")
+        keys = []
+        for size in sizes:
+            keys += fill(con, len(keys), size)
+            sample = [keys[i] for i in rng.integers(len(keys), size=lookups)]
+
+            def lookup(sample=sample):
+                for key in sample:
+                    con.execute(
+                        "SELECT level, svg_encoded FROM solutions WHERE key=?", (key,)
+                    ).fetchone()
+
+            seconds = min(timeit.repeat(lookup, number=1, repeat=3))
+            print(f"{size:>9} rows: {seconds / lookups * 1e6:6.2f} µs per lookup")
+        con.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""Compare `numerics.level_batch()` against calling `numerics.level()` in a loop.
+
+Run from the repository root with `python -m benchmarks.bench_level_batch`.
+"""
+
+import timeit
+
+import numpy as np
+
+from water_filling import numerics
+
+rng = np.random.default_rng(0)
+
+
+def main(m=10_000):
+    instances = [numerics.random()[0] for _ in range(m)]
+    volumes = rng.integers(1, 300, size=m)
+
+    def loop():
+        return [numerics.level(h, v) for h, v in zip(instances, volumes)]
+
+    def batch():
+        heights, sizes = numerics.list_to_padded(instances)
+        return numerics.level_batch(heights, volumes, sizes)
+
+    assert np.allclose(loop(), batch())
+
+    for name, f in [("loop", loop), ("batch", batch)]:
+        seconds = min(timeit.repeat(f, number=1, repeat=5))
+        print(f"{name:>5}: {seconds * 1e3:8.2f} ms for {m} instances")
+
+
+if __name__ == "__main__":
+    main()
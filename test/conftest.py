@@ -1,10 +1,9 @@
-import sqlite3
 from collections import namedtuple
 
 import pytest
 from microdot.test_client import TestClient
 
-from water_filling import database
+from water_filling import database, interface, pages
 from water_filling.interface import app
 
 WaterFillingTriple = namedtuple("WaterFillingTriple", "heights volume level".split())
@@ -37,12 +36,29 @@ def triple(request):
 def mock_db(monkeypatch, tmp_path):
     """Fixture that mocks the DB to a temporary file to test caching."""
     db_path = tmp_path / "water_filling.cache.db"
-    con = sqlite3.connect(db_path)
+    con = database.connect(db_path)
+    writer = database.Writer(db_path)
+    readers = database.Readers(db_path, workers=2)
     with monkeypatch.context() as m:
         m.setattr(database, "con", con)
+        m.setattr(database, "writer", writer)
+        m.setattr(database, "readers", readers)
+        m.setattr(database, "accesses", {})
+        m.setattr(database, "memory", database.MemoryCache(2**20))
+        m.setattr(
+            database, "disk_stats", database.Counter(hits=0, misses=0, evictions=0)
+        )
+        m.setattr(database, "level_stats", database.Counter(hits=0, misses=0))
+        m.setattr(database, "inflight", {})
+        m.setattr(database, "inflight_stats", database.Counter(coalesced=0))
         yield
+    writer.close()
+    readers.close()
+    con.close()
 
 
 @pytest.fixture(scope="function")
-def client(mock_db):
+def client(mock_db, monkeypatch):
+    monkeypatch.setattr(interface, "rendered_pages", pages.BodyCache(2**20))
+    monkeypatch.setattr(interface, "compressed_bodies", pages.BodyCache(2**20))
     yield TestClient(app)
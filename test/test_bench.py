@@ -0,0 +1,63 @@
+import asyncio
+import itertools
+
+import pytest
+
+from water_filling.bench import Bench
+
+
+def counter():
+    count = itertools.count()
+
+    async def produce():
+        await asyncio.sleep(0)
+        return next(count)
+
+    return produce
+
+
+@pytest.mark.asyncio
+async def test_bench__fill():
+    bench = Bench(counter(), min_size=4, max_size=16)
+    assert bench.pop() is None
+    assert bench.stats["underflows"] == 1
+
+    task = asyncio.create_task(bench.run())
+    await asyncio.sleep(0.01)
+    assert len(bench) == bench.high_watermark() == 4
+    assert [bench.pop(), bench.pop()] == [0, 1]
+    # Not below the low watermark yet, so no refill
+    await asyncio.sleep(0.01)
+    assert len(bench) == 2
+
+    bench.pop()
+    await asyncio.sleep(0.01)
+    assert len(bench) == bench.high_watermark()
+    assert bench.stats["served"] == 3
+    task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_bench__adaptive():
+    bench = Bench(counter(), min_size=2, max_size=16, horizon=1.0)
+    task = asyncio.create_task(bench.run())
+    await asyncio.sleep(0.01)
+    assert len(bench) == 2
+
+    # A burst raises the watermarks, up to `max_size`
+    for _ in range(10):
+        bench.pop()
+    assert bench.high_watermark() == 10
+    await asyncio.sleep(0.01)
+    assert len(bench) == 10
+    for _ in range(100):
+        bench.pop()
+    assert bench.high_watermark() == 16
+    report = bench.report()
+    assert report["served"] + report["underflows"] == 110
+    assert report["rate"] == 110.0
+
+    # Then demand decays
+    await asyncio.sleep(1.01)
+    assert bench.high_watermark() == 2
+    task.cancel()
@@ -1,4 +1,9 @@
+import asyncio
+import sqlite3
+import threading
+
 import numpy as np
+import pytest
 
 from water_filling import database
 
@@ -18,8 +23,9 @@ def test_fulfill_as_json_serializable_skip_cache(mock_db, triple):
     assert res["bench"] is False
 
 
-def test_fulfill_as_json_serializable_with_cache(mock_db, triple):
-    res = database.fulfill_as_json_serializable_with_cache(
+@pytest.mark.asyncio
+async def test_fulfill_as_json_serializable_with_cache_async(mock_db, triple):
+    res = await database.fulfill_as_json_serializable_with_cache_async(
         np.asanyarray(triple.heights), np.asanyarray(triple.volume)[()]
     )
     assert res["heights"] == triple.heights
@@ -32,10 +38,329 @@ def test_fulfill_as_json_serializable_with_cache(mock_db, triple):
     assert res["cached"] is False
     assert res["bench"] is False
 
-    res2 = database.fulfill_as_json_serializable_with_cache(
+    res2 = await database.fulfill_as_json_serializable_with_cache_async(
         np.asanyarray(triple.heights), np.asanyarray(triple.volume)[()]
     )
     assert res2["cached"] is True
     for key in res.keys():
         if key != "cached":
             assert res[key] == res2[key]
+
+
+@pytest.mark.asyncio
+async def test_fulfill_as_json_serializable_with_cache_async__lazy_svg(mock_db, triple):
+    heights = np.asanyarray(triple.heights)
+    volume = np.asanyarray(triple.volume)[()]
+    res = await database.fulfill_as_json_serializable_with_cache_async(
+        heights, volume, include_svg=False
+    )
+    assert res["svg"] is None
+    assert res["cached"] is False
+
+    res2 = await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    assert isinstance(res2["svg"], str)
+    assert res2["level"] == res["level"]
+
+    # From disk this time
+    database.writer.flush()
+    database.memory = database.MemoryCache(2**20)
+    res3 = await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    assert res3["svg"] == res2["svg"]
+    assert res3["cached"] is True
+
+
+def test_migrate__legacy_table(tmp_path):
+    """Rows of the unversioned table are rekeyed with their dtypes recovered."""
+    db_path = tmp_path / "legacy.cache.db"
+    con = sqlite3.connect(db_path)
+    con.execute("""
+    CREATE TABLE water_filling (
+        heights BLOB,
+        volume BLOB,
+        level REAL,
+        svg TEXT
+    ) STRICT
+    """)
+    legacy_rows = [
+        (np.array([1, 2, 3, 4]), np.int_(6), 4.0, "<svg/>"),
+        (np.array([1.0, 2, 3, 4]), np.float64(0.5), 1.5, None),
+    ]
+    with con:
+        for heights, volume, level, svg_data in legacy_rows:
+            con.execute(
+                "INSERT INTO water_filling VALUES (?,?,?,?)",
+                (heights.tobytes(), volume.tobytes(), level, svg_data),
+            )
+        # Garbage that no dtype explains
+        con.execute(
+            "INSERT INTO water_filling VALUES (?,?,?,?)",
+            (b"\xff" * 16, np.int_(1).tobytes(), 0.0, None),
+        )
+    con.close()
+
+    con = database.connect(db_path)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == len(database.migrations)
+    assert con.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert con.execute("SELECT count(*) FROM solutions").fetchone()[0] == 2
+    for heights, volume, level, svg_data in legacy_rows:
+        fetched_level, svg_encoded, svg_codec = con.execute(
+            "SELECT level, svg_encoded, svg_codec FROM solutions WHERE key=?",
+            (database.digest(heights, volume),),
+        ).fetchone()
+        assert fetched_level == level
+        if svg_data is None:
+            assert svg_encoded is None
+        else:
+            assert database.decode_svg(svg_encoded, svg_codec) == svg_data
+    assert not con.execute(
+        "SELECT 1 FROM sqlite_schema WHERE name='water_filling'"
+    ).fetchone()
+
+
+async def fill_cache(n):
+    """Cache `n` distinct instances, returning their keys in order of creation."""
+    keys = []
+    for volume in range(n):
+        heights = np.arange(4)
+        volume = np.int_(volume)
+        await database.fulfill_as_json_serializable_with_cache_async(
+            heights, volume, include_svg=False
+        )
+        keys.append(database.digest(heights, volume))
+    database.writer.flush()
+    return keys
+
+
+def cached_keys():
+    return {key for (key,) in database.con.execute("SELECT key FROM solutions")}
+
+
+@pytest.mark.asyncio
+async def test_record_access(mock_db):
+    (key,) = await fill_cache(1)
+    for _ in range(3):
+        await database.fulfill_as_json_serializable_with_cache_async(
+            np.arange(4), np.int_(0), include_svg=False
+        )
+    # Batched in memory until flushed
+    query = "SELECT hits FROM solutions WHERE key=?"
+    assert database.con.execute(query, (key,)).fetchone() == (0,)
+    database.flush_accesses().result()
+    assert database.con.execute(query, (key,)).fetchone() == (3,)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("policy", ["lru", "lfu"])
+async def test_evict_async__max_rows(mock_db, policy):
+    keys = await fill_cache(5)
+    # Touch the oldest instance so that it is the most recently (and frequently)
+    # used one
+    await database.fulfill_as_json_serializable_with_cache_async(
+        np.arange(4), np.int_(0), include_svg=False
+    )
+    assert await database.evict_async(max_rows=2, policy=policy) == 3
+    assert cached_keys() == {keys[0], keys[4]}
+
+
+@pytest.mark.asyncio
+async def test_evict_async__max_bytes(mock_db):
+    keys = await fill_cache(5)
+    (size,) = database.con.execute("SELECT size FROM solutions LIMIT 1").fetchone()
+    assert await database.evict_async(max_bytes=3 * size) == 2
+    assert cached_keys() == set(keys[2:])
+
+
+@pytest.mark.asyncio
+async def test_evict_async__ttl(mock_db):
+    await fill_cache(3)
+    assert await database.evict_async(ttl=3600) == 0
+    assert await database.evict_async(ttl=-1) == 3
+    assert cached_keys() == set()
+
+
+@pytest.mark.parametrize("codec", database.codecs)
+def test_encode_svg(codec):
+    svg_data = "<svg>" + "<path/>" * 100 + "</svg>"
+    svg_encoded = database.encode_svg(svg_data, codec)
+    assert isinstance(svg_encoded, bytes)
+    assert database.decode_svg(svg_encoded, codec) == svg_data
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("codec", database.codecs)
+async def test_fetch_svg_encoded_async(mock_db, monkeypatch, codec):
+    monkeypatch.setattr(database.options, "cache_codec", codec)
+    heights, volume = np.arange(4), np.int_(3)
+    res = await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    database.writer.flush()
+    key = database.digest(heights, volume)
+    assert await database.fetch_svg_encoded_async(key, "no such codec") is None
+    svg_encoded = await database.fetch_svg_encoded_async(key, codec)
+    assert database.decode_svg(svg_encoded, codec) == res["svg"]
+    res2 = await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    assert res2["svg"] == res["svg"]
+
+
+@pytest.mark.asyncio
+async def test_fulfill_as_json_serializable_with_cache_async__writer(mock_db, triple):
+    heights = np.asanyarray(triple.heights)
+    volume = np.asanyarray(triple.volume)[()]
+    res = await database.fulfill_as_json_serializable_with_cache_async(
+        heights, volume, include_svg=False
+    )
+    assert res["cached"] is False
+    # Visible before the writer commits, and on disk after
+    res2 = await database.fulfill_as_json_serializable_with_cache_async(
+        heights, volume, include_svg=False
+    )
+    assert res2["cached"] is True
+    assert res2["level"] == res["level"]
+    database.writer.flush()
+    assert not database.writer.pending
+    assert cached_keys() == {database.digest(heights, volume)}
+
+    res3 = await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    assert isinstance(res3["svg"], str)
+    database.writer.flush()
+    database.memory = database.MemoryCache(2**20)
+    res4 = await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    assert res4["svg"] == res3["svg"]
+    assert res4["cached"] is True
+
+
+def test_writer__group_commit(mock_db):
+    def insert(con, i):
+        con.execute("CREATE TABLE IF NOT EXISTS t (i INTEGER)")
+        con.execute("INSERT INTO t VALUES (?)", (i,))
+        return i
+
+    def fail(con):
+        con.execute("INSERT INTO t VALUES (-1)")
+        raise ValueError("failed")
+
+    futures = [database.writer.submit(insert, i) for i in range(100)]
+    failed = database.writer.submit(fail)
+    assert [future.result() for future in futures] == list(range(100))
+    with pytest.raises(ValueError, match="failed"):
+        failed.result()
+    # The failed operation was rolled back without affecting the others
+    (count, total) = database.con.execute("SELECT count(*), sum(i) FROM t").fetchone()
+    assert (count, total) == (100, sum(range(100)))
+
+
+def test_submit_pending__newer(mock_db):
+    def blocked(con, started, release):
+        started.set()
+        release.wait()
+
+    started, releases = threading.Event(), [threading.Event(), threading.Event()]
+    first = database._submit_pending(b"k", (1.0, None), blocked, started, releases[0])
+    started.wait()
+    # Replaced while the first write is being committed, in a later batch
+    second = database._submit_pending(
+        b"k", (2.0, None), blocked, threading.Event(), releases[1]
+    )
+    first_done = threading.Event()
+    first.add_done_callback(lambda _: first_done.set())
+    releases[0].set()
+    assert first_done.wait(10)
+    assert database.writer.pending[b"k"] == (2.0, None)
+    releases[1].set()
+    second.result(10)
+    assert b"k" not in database.writer.pending
+
+
+def test_memory_cache():
+    heights, volume = np.arange(4), np.int_(3)
+    as_dict = database.fulfill_as_json_serializable_skip_cache(heights, volume)
+    size = database.MemoryCache.size(as_dict)
+    memory = database.MemoryCache(max_bytes=2 * size)
+    assert memory.get(b"a") is None
+
+    memory.put(b"a", as_dict)
+    memory.put(b"b", dict(as_dict, svg=None))
+    assert memory.get(b"b") is None
+    assert memory.get(b"b", include_svg=False)["cached"] is True
+    res = memory.get(b"a")
+    assert res["cached"] is True
+    assert res["svg"] == as_dict["svg"]
+    # Copies are returned, so the cached entry is not affected
+    res["svg"] = None
+    assert memory.get(b"a")["svg"] == as_dict["svg"]
+
+    # "b" is the least recently used, and gets evicted
+    memory.put(b"c", as_dict)
+    assert memory.get(b"b", include_svg=False) is None
+    assert len(memory) == 2
+    assert memory.nbytes <= memory.max_bytes
+    assert memory.stats == {"hits": 3, "misses": 3, "evictions": 1}
+
+
+@pytest.mark.asyncio
+async def test_fulfill_as_json_serializable_with_cache_async__memory(mock_db):
+    heights, volume = np.arange(4), np.int_(3)
+    await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    res = await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    assert res["cached"] is True
+    stats = database.stats()
+    assert stats["memory"]["hits"] == 1
+    assert stats["memory"]["entries"] == 1
+    assert stats["disk"]["hits"] == 0
+    assert stats["disk"]["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_fulfill_as_json_serializable_with_cache_async__coalesced(
+    mock_db, monkeypatch
+):
+    renders = []
+    render_svg_async = database.render.render_svg_async
+
+    async def counting_render_svg_async(heights, level):
+        renders.append(level)
+        return await render_svg_async(heights, level)
+
+    monkeypatch.setattr(database.render, "render_svg_async", counting_render_svg_async)
+    heights, volume = np.arange(4), np.int_(3)
+    results = await asyncio.gather(
+        *(
+            database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+            for _ in range(10)
+        )
+    )
+    assert len(renders) == 1
+    assert all(res == results[0] for res in results)
+    assert database.stats()["inflight"] == {"coalesced": 9, "pending": 0}
+
+
+def test_canonical_digest():
+    key, shift = database.canonical_digest(np.array([1, 2, 3]), np.int_(2))
+    assert shift == 1
+    for heights, volume in [
+        (np.array([1.0, 2.0, 3.0]), np.float64(2.0)),
+        (np.array([3, 1, 2]), np.int_(2)),
+        (np.array([11, 12, 13]), np.int_(2)),
+    ]:
+        assert database.canonical_digest(heights, volume)[0] == key
+    assert database.canonical_digest(np.array([1, 2, 4]), np.int_(2))[0] != key
+    assert database.canonical_digest(np.array([1, 2, 3]), np.int_(3))[0] != key
+
+
+@pytest.mark.asyncio
+async def test_fulfill_as_json_serializable_with_cache_async__canonical_level(
+    mock_db, triple
+):
+    heights = np.asanyarray(triple.heights)
+    volume = np.asanyarray(triple.volume)[()]
+    await database.fulfill_as_json_serializable_with_cache_async(heights, volume, False)
+    assert database.level_stats == {"hits": 0, "misses": 1}
+    database.writer.flush()
+
+    # Reordered and shifted, with float dtype: a new solution, but a known level
+    equivalent = heights[::-1].astype(np.float64) + 100
+    res = await database.fulfill_as_json_serializable_with_cache_async(
+        equivalent, volume, False
+    )
+    assert database.level_stats == {"hits": 1, "misses": 1}
+    assert res["cached"] is False
+    assert np.isclose(res["level"], triple.level + 100)
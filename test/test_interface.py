@@ -1,10 +1,22 @@
+import gzip
+import io
 import json
 import re
+import zlib
 
 import numpy as np
 import pytest
+from microdot import Request
 
-from water_filling import serialization
+from water_filling import (
+    compression,
+    database,
+    interface,
+    numerics,
+    pages,
+    serialization,
+)
+from water_filling.bench import Bench
 
 
 @pytest.mark.asyncio
@@ -37,6 +49,27 @@ async def test_get_level_svg(client, triple):
     assert resp.text.lower().strip().endswith("</svg>")
 
 
+@pytest.mark.asyncio
+async def test_get_level_svg__gzip(client, monkeypatch, triple):
+    path = serialization.to_path(triple.heights, triple.volume)
+    headers = {"Accept": "image/svg", "Accept-Encoding": "br;q=0, gzip;q=0.8"}
+    resp = await client.get(path, headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == "gzip"
+    svg_data = gzip.decompress(resp.body).decode()
+    assert "http://www.w3.org/2000/svg" in svg_data
+
+    # Now cached once the writer commits, and served as stored
+    database.writer.flush()
+    compressed_bodies = pages.BodyCache(0)
+    monkeypatch.setattr(interface, "compressed_bodies", compressed_bodies)
+    monkeypatch.setattr(compression, "encoders", {})
+    resp2 = await client.get(path, headers=headers)
+    assert resp2.status_code == 200
+    assert resp2.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(resp2.body).decode() == svg_data
+
+
 @pytest.mark.asyncio
 async def test_get_level_json(client, triple):
     path = serialization.to_path(triple.heights, triple.volume)
@@ -46,7 +79,7 @@ async def test_get_level_json(client, triple):
     assert content["heights"] == triple.heights
     assert content["volume"] == triple.volume
     assert np.isclose(content["level"], triple.level)
-    assert "http://www.w3.org/2000/svg" in content["svg"]
+    assert "svg" not in content
     assert content["cached"] is False
 
     # Issue the same request again, ensure it was pulled from cache
@@ -56,9 +89,26 @@ async def test_get_level_json(client, triple):
     assert content2["heights"] == triple.heights
     assert content2["volume"] == triple.volume
     assert np.isclose(content2["level"], triple.level)
-    assert "http://www.w3.org/2000/svg" in content2["svg"]
+    assert "svg" not in content2
     assert content2["cached"] is True
 
+    # Ask for the SVG too; the level is cached but the SVG must be rendered
+    resp3 = await client.get(
+        path + "&include=svg", headers={"Accept": "application/json"}
+    )
+    assert resp3.status_code == 200
+    content3 = json.loads(resp3.text)
+    assert np.isclose(content3["level"], triple.level)
+    assert "http://www.w3.org/2000/svg" in content3["svg"]
+    assert content3["cached"] is False
+
+    resp4 = await client.get(
+        path + "&include=svg", headers={"Accept": "application/json"}
+    )
+    content4 = json.loads(resp4.text)
+    assert content4["svg"] == content3["svg"]
+    assert content4["cached"] is True
+
 
 @pytest.mark.asyncio
 async def test_get_random_html(client):
@@ -91,5 +141,364 @@ async def test_get_random_json(client):
     assert "heights_repr" not in content
     assert "volume_repr" not in content
     assert "level_repr" not in content
-    assert "http://www.w3.org/2000/svg" in content["svg"]
+    assert "svg" not in content
     assert content["cached"] is False
+
+
+@pytest.mark.asyncio
+async def test_get_random_json__include_svg(client):
+    path = "/random?include=svg"
+    resp = await client.get(path, headers={"Accept": "application/json"})
+    assert resp.status_code == 200
+    content = json.loads(resp.text)
+    assert "http://www.w3.org/2000/svg" in content["svg"]
+
+
+@pytest.mark.asyncio
+async def test_get_stats(client):
+    path = serialization.to_path([1, 2, 3], 2)
+    for _ in range(3):
+        await client.get(path, headers={"Accept": "application/json"})
+    resp = await client.get("/stats")
+    assert resp.status_code == 200
+    content = json.loads(resp.text)
+    assert content["cache"]["memory"]["hits"] == 2
+    assert content["cache"]["memory"]["misses"] == 1
+    assert content["cache"]["disk"]["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_post_level_json(client, triple):
+    resp = await client.post(
+        f"/level?volume={triple.volume}",
+        headers={"Accept": "application/json"},
+        body=triple.heights,
+    )
+    assert resp.status_code == 200
+    content = json.loads(resp.text)
+    assert content["heights"] == triple.heights
+    assert np.isclose(content["level"], triple.level)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("dtype", ["float64", "int64"])
+async def test_post_level_octet_stream(client, triple, dtype):
+    heights = np.array(triple.heights, dtype="<" + np.dtype(dtype).str[1:])
+    resp = await client.post(
+        f"/level?volume={triple.volume}&dtype={dtype}",
+        headers={
+            "Accept": "application/json",
+            "Content-Type": "application/octet-stream",
+        },
+        body=heights.tobytes(),
+    )
+    assert resp.status_code == 200
+    content = json.loads(resp.text)
+    assert content["heights"] == heights.tolist()
+    assert np.isclose(content["level"], triple.level)
+
+
+@pytest.mark.asyncio
+async def test_post_level_npy(client):
+    heights = np.arange(2**16 - 1, dtype=np.float64)
+    stream = io.BytesIO()
+    np.save(stream, heights)
+    resp = await client.post(
+        "/level?volume=10",
+        headers={"Accept": "application/json", "Content-Type": "application/x-npy"},
+        body=stream.getvalue(),
+    )
+    assert resp.status_code == 200
+    content = json.loads(resp.text)
+    assert len(content["heights"]) == heights.size
+    assert np.isclose(content["level"], numerics.level(heights, 10))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "content_type,body",
+    [
+        ("application/json", b"[1, 2, 3"),
+        pytest.param("application/json", b"[" * 50000, id="json-nested"),
+        ("application/octet-stream", b"\0" * 7),
+        ("application/x-npy", b"\0" * 8),
+        pytest.param(
+            "application/x-npy",
+            b"\x93NUMPY\x01\x00v\x00"
+            + b"{'descr': '<f8', 'fortran_order': False, 'shape': (3, }".ljust(117)
+            + b"\n"
+            + b"\0" * 24,
+            id="npy-truncated-header",
+        ),
+    ],
+)
+async def test_post_level__bad(client, content_type, body):
+    resp = await client.post(
+        "/level?volume=1", headers={"Content-Type": content_type}, body=body
+    )
+    assert resp.status_code == 400
+
+
+def ndjson(lines):
+    return "".join(line + "\n" for line in lines).encode()
+
+
+@pytest.mark.asyncio
+async def test_post_levels_json(client):
+    problems = [{"heights": [1, 2, 3, 4], "volume": v} for v in range(10)]
+    resp = await client.post("/levels", body=problems)
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == "application/x-ndjson"
+    solutions = [json.loads(line) for line in resp.text.splitlines()]
+    assert len(solutions) == len(problems)
+    for problem, solution in zip(problems, solutions, strict=True):
+        assert solution.keys() == {"level"}
+        assert np.isclose(
+            solution["level"], numerics.level(problem["heights"], problem["volume"])
+        )
+
+
+@pytest.mark.asyncio
+async def test_post_levels_ndjson(client, monkeypatch, triple):
+    # Small chunks, and a body too large to be read at once
+    monkeypatch.setattr(interface, "batch_max_rows", 3)
+    monkeypatch.setattr(Request, "max_body_length", 64)
+    problem = json.dumps({"heights": triple.heights, "volume": triple.volume})
+    lines = [problem] * 5 + ["not json", "[" * 50000, '{"heights": [], "volume": 1}']
+    lines += [problem]
+    resp = await client.post(
+        "/levels", headers={"Content-Type": "application/x-ndjson"}, body=ndjson(lines)
+    )
+    assert resp.status_code == 200
+    solutions = [json.loads(line) for line in resp.text.splitlines()]
+    assert len(solutions) == len(lines)
+    for solution in solutions[5:8]:
+        assert solution == {"error": "Invalid problem"}
+    for solution in solutions[:5] + solutions[8:]:
+        assert np.isclose(solution["level"], triple.level)
+
+
+@pytest.mark.asyncio
+async def test_post_levels__large(client, monkeypatch):
+    monkeypatch.setattr(Request, "max_body_length", 64)
+    monkeypatch.setattr(Request, "max_content_length", 64)
+    problems = [{"heights": [1, 2, 3, 4], "volume": v} for v in range(10)]
+    lines = [json.dumps(problem) for problem in problems]
+    resp = await client.post(
+        "/levels", headers={"Content-Type": "application/x-ndjson"}, body=ndjson(lines)
+    )
+    assert resp.status_code == 200
+    assert len(resp.text.splitlines()) == len(problems)
+
+    # Only NDJSON batches may be that large
+    resp = await client.post("/levels", body=problems)
+    assert resp.status_code == 413
+    resp = await client.post("/level?volume=1", body=list(range(100)))
+    assert resp.status_code == 413
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("trailing_newline", [False, True])
+async def test_post_levels__long_line(client, monkeypatch, trailing_newline):
+    monkeypatch.setattr(Request, "max_body_length", 64)
+    monkeypatch.setattr(Request, "max_content_length", 64)
+    problem = json.dumps({"heights": [1, 2, 3, 4], "volume": 6})
+    long_problem = json.dumps({"heights": [1] * 100, "volume": 6})
+    lines = [problem, long_problem, problem, long_problem]
+    body = ndjson(lines)
+    if not trailing_newline:
+        body = body.removesuffix(b"\n")
+    resp = await client.post(
+        "/levels", headers={"Content-Type": "application/x-ndjson"}, body=body
+    )
+    assert resp.status_code == 200
+    solutions = [json.loads(line) for line in resp.text.splitlines()]
+    assert solutions == [{"level": 4}, {"error": "Invalid problem"}] * 2
+
+
+@pytest.mark.asyncio
+async def test_post_levels__include_svg(client):
+    problems = [{"heights": [1, 2, 3], "volume": 2}, {"heights": [3, 1], "volume": 1}]
+    resp = await client.post("/levels?include=svg", body=problems)
+    solutions = [json.loads(line) for line in resp.text.splitlines()]
+    for solution in solutions:
+        assert "http://www.w3.org/2000/svg" in solution["svg"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "content_type,body",
+    [
+        ("application/json", b'{"heights": [1], "volume": 1}'),
+        ("application/json", b"[1, 2"),
+        pytest.param("application/json", b"[" * 50000, id="json-nested"),
+        ("text/plain", b"[]"),
+    ],
+)
+async def test_post_levels__bad(client, content_type, body):
+    resp = await client.post(
+        "/levels", headers={"Content-Type": content_type}, body=body
+    )
+    assert resp.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_get_level__etag(client, monkeypatch):
+    path = serialization.to_path([1, 2, 3], 2)
+    resp = await client.get(path, headers={"Accept": "text/html"})
+    assert resp.status_code == 200
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert "Accept" in resp.headers["Vary"]
+    tag = resp.headers["ETag"]
+    assert tag.startswith('W/"')
+
+    # Other representations have other ETags
+    resp_json = await client.get(path, headers={"Accept": "application/json"})
+    resp_json_svg = await client.get(
+        path + "&include=svg", headers={"Accept": "application/json"}
+    )
+    assert len({tag, resp_json.headers["ETag"], resp_json_svg.headers["ETag"]}) == 3
+
+    # Revalidation does not load the solution
+    async def fail(*args, **kwargs):
+        raise AssertionError("Solution loaded")
+
+    monkeypatch.setattr(database, "fulfill_as_json_serializable_with_cache_async", fail)
+    for if_none_match in [tag, tag.removeprefix("W/"), f'"other", {tag}', "*"]:
+        resp2 = await client.get(
+            path, headers={"Accept": "text/html", "If-None-Match": if_none_match}
+        )
+        assert resp2.status_code == 304
+        assert resp2.body == b""
+        assert resp2.headers["ETag"] == tag
+
+
+@pytest.mark.asyncio
+async def test_get_style(client):
+    resp = await client.get("/style.css")
+    assert resp.status_code == 200
+    assert "immutable" not in resp.headers["Cache-Control"]
+    assert "Max-Age" not in resp.headers
+
+    html = (await client.get("/", headers={"Accept": "text/html"})).text
+    (href,) = re.findall(r'href="(/style\.css\?v=\w+)"', html)
+    resp2 = await client.get(href)
+    assert "immutable" in resp2.headers["Cache-Control"]
+    assert resp2.body == resp.body
+
+    resp3 = await client.get(href, headers={"If-None-Match": resp.headers["ETag"]})
+    assert resp3.status_code == 304
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("coding", ["gzip", "deflate"])
+async def test_compress_response(client, monkeypatch, coding):
+    path = serialization.to_path(list(range(100)), 50)
+    headers = {"Accept": "text/html", "Accept-Encoding": f"{coding}, identity;q=0.5"}
+    resp = await client.get(path, headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers["Content-Encoding"] == coding
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    decompress = {"gzip": gzip.decompress, "deflate": zlib.decompress}[coding]
+    html = decompress(resp.body).decode()
+    assert "<svg" in html
+    assert len(resp.body) < len(html)
+    assert len(interface.compressed_bodies) == 0
+
+    # Compressed once per ETag, once the solution is cached
+    resp2 = await client.get(path, headers=headers)
+    assert len(interface.compressed_bodies) == 1
+    monkeypatch.setattr(compression, "encoders", {coding: None})
+    resp3 = await client.get(path, headers=headers)
+    assert resp3.body == resp2.body
+
+
+@pytest.mark.asyncio
+async def test_compress_response__cached(client):
+    path = serialization.to_path(list(range(100)), 50)
+    headers = {"Accept": "text/html", "Accept-Encoding": "gzip"}
+    resp = await client.get(path, headers=headers)
+    resp2 = await client.get(path, headers=headers)
+    assert resp2.headers["Content-Encoding"] == "gzip"
+    assert "retrieved from the cache" not in gzip.decompress(resp.body).decode()
+    assert "retrieved from the cache" in gzip.decompress(resp2.body).decode()
+
+
+@pytest.mark.asyncio
+async def test_compress_response__small(client):
+    path = serialization.to_path([1, 2, 3], 2)
+    headers = {"Accept": "application/json", "Accept-Encoding": "gzip"}
+    resp = await client.get(path, headers=headers)
+    assert "Content-Encoding" not in resp.headers
+    assert json.loads(resp.text)["level"] == 2.5
+
+
+@pytest.mark.asyncio
+async def test_get_random__bench(client, monkeypatch):
+    entry = await interface.make_bench_entry()
+    bench = Bench(None)
+    bench.entries.extend([entry] * 4)
+    monkeypatch.setattr(interface, "bench", bench)
+
+    resp = await client.get("/random", headers={"Accept": "text/html"})
+    assert resp.text == entry["html"]
+    resp = await client.get("/random", headers={"Accept": "image/svg"})
+    assert resp.text == entry["svg"]
+    resp = await client.get("/random", headers={"Accept": "application/json"})
+    assert json.loads(resp.text)["bench"] is True
+    assert "svg" not in json.loads(resp.text)
+    resp = await client.get("/random?include=svg")
+    assert json.loads(resp.text)["svg"] == entry["svg"]
+
+    content = json.loads((await client.get("/stats")).text)
+    assert content["bench"]["served"] == 4
+    assert content["bench"]["underflows"] == 0
+
+
+@pytest.mark.asyncio
+async def test_get_level_html__rendered_pages(client, monkeypatch):
+    path = serialization.to_path([1, 2, 3], 2)
+    headers = {"Accept": "text/html"}
+    resp = await client.get(path, headers=headers)
+    assert len(interface.rendered_pages) == 0
+    resp2 = await client.get(path, headers=headers)
+    assert len(interface.rendered_pages) == 1
+
+    async def fail(*args, **kwargs):
+        raise AssertionError("Solution loaded")
+
+    monkeypatch.setattr(database, "fulfill_as_json_serializable_with_cache_async", fail)
+    resp3 = await client.get(path, headers=headers)
+    assert resp3.body == resp2.body != resp.body
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("coding", ["identity", "gzip", "deflate"])
+async def test_get_level_html__streamed(client, monkeypatch, coding):
+    path = serialization.to_path(list(range(50)), 20)
+    headers = {"Accept": "text/html", "Accept-Encoding": coding}
+    await client.get(path, headers={"Accept": "text/html"})
+    # Now cached, and the same from here on
+    whole = (await client.get(path, headers={"Accept": "text/html"})).text
+    monkeypatch.setattr(interface.options, "stream_svg_bytes", 0)
+    monkeypatch.setattr(interface, "rendered_pages", pages.BodyCache(0))
+
+    resp = await client.get(path, headers=headers)
+    assert resp.status_code == 200
+    body = resp.body
+    if coding != "identity":
+        assert resp.headers["Content-Encoding"] == coding
+        body = {"gzip": gzip.decompress, "deflate": zlib.decompress}[coding](body)
+    assert body.decode() == whole
+    assert pages.svg_sentinel not in body.decode()
+
+
+@pytest.mark.asyncio
+async def test_post_levels__gzip(client):
+    problems = [{"heights": [1, 2, 3, 4], "volume": v} for v in range(100)]
+    resp = await client.post(
+        "/levels", headers={"Accept-Encoding": "gzip"}, body=problems
+    )
+    assert resp.headers["Content-Encoding"] == "gzip"
+    lines = gzip.decompress(resp.body).decode().splitlines()
+    assert len(lines) == len(problems)
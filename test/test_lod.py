@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from water_filling import lod
+
+
+def test_envelope__small():
+    edges, tops = lod.envelope([3, 1, 2], max_columns=10)
+    assert edges.tolist() == [-0.5, 0.5, 1.5, 2.5]
+    assert tops.tolist() == [3, 1, 2]
+
+
+@pytest.mark.parametrize(
+    "n,max_columns", [(10, 2), (10, 3), (10, 4), (1001, 100), (2**16 - 1, 1024)]
+)
+def test_envelope__large(n, max_columns):
+    heights = np.random.default_rng(0).normal(size=n)
+    edges, tops = lod.envelope(heights, max_columns)
+    assert tops.size <= max_columns
+    assert edges.size == tops.size + 1
+    assert edges[0] == -0.5
+    assert edges[-1] == n - 0.5
+    assert (np.diff(edges) > 0).all()
+    # Extremes are preserved
+    assert tops.max() == heights.max()
+    assert tops.min() == heights.min()
+
+
+@pytest.mark.parametrize("max_columns", [0, 1])
+def test_envelope__too_few_columns(max_columns):
+    with pytest.raises(ValueError, match="at least 2"):
+        lod.envelope(np.arange(10), max_columns)
@@ -42,3 +42,196 @@ def test_random(triple):
     assert heights.ndim == 1
     assert np.isfinite(heights).all()
     assert volume > 0
+
+
+def test_level_many(triple):
+    """`water_filling.level_many()` agrees with `level()` elementwise."""
+    volumes = np.array([triple.volume, 0.0, 0.5 * triple.volume, 3 * triple.volume])
+    levels = numerics.level_many(triple.heights, volumes)
+    assert levels.shape == volumes.shape
+    assert np.isclose(levels[0], triple.level)
+    for v, lev in zip(volumes, levels):
+        assert np.isclose(lev, numerics.level(triple.heights, v))
+
+
+def test_level_many__negative_volume():
+    with pytest.raises(ValueError):
+        numerics.level_many([1, 2, 3], [1.0, -1.0])
+
+
+def test_level_batch():
+    """`water_filling.level_batch()` agrees with `level()` on each instance."""
+    rng = np.random.default_rng(0)
+    instances = [rng.integers(-5, 6, size=rng.integers(1, 9)) for _ in range(50)]
+    volumes = rng.uniform(0, 40, size=len(instances))
+    heights, sizes = numerics.list_to_padded(instances)
+    levels = numerics.level_batch(heights, volumes, sizes)
+    for h, v, lev in zip(instances, volumes, levels):
+        assert np.isclose(lev, numerics.level(h, v))
+
+
+def test_level_batch__triple(triple):
+    levels = numerics.level_batch([triple.heights], [triple.volume])
+    assert np.isclose(levels[0], triple.level)
+
+
+def test_csr_to_padded():
+    heights, sizes = numerics.csr_to_padded([1, 2, 3, 4, 5, 6], [0, 1, 4, 6])
+    assert sizes.tolist() == [1, 3, 2]
+    assert heights.tolist() == [[1, 0, 0], [2, 3, 4], [5, 6, 0]]
+
+
+@pytest.mark.parametrize("strategy", ["sort", "select"])
+def test_level__strategy(triple, strategy):
+    level_estimated = numerics.level(triple.heights, triple.volume, strategy)
+    assert isinstance(level_estimated, np.float64)
+    assert np.isclose(level_estimated, triple.level)
+
+
+def test_level_select__random():
+    """`water_filling.level_select()` agrees with sorting on larger inputs."""
+    rng = np.random.default_rng(0)
+    heights = rng.normal(size=10_001)
+    heights[::7] = 0.0  # Plenty of ties
+    for v in [0.0, 1.0, 100.0, 1e4, 1e6]:
+        assert np.isclose(
+            numerics.level_select(heights, v), numerics.level(heights, v, "sort")
+        )
+
+
+def test_terrain(triple):
+    """`water_filling.Terrain` recovers volume and level."""
+    terrain = numerics.Terrain(triple.heights)
+    assert np.isclose(terrain.level(triple.volume), triple.level)
+    assert np.isclose(terrain.volume(triple.level), triple.volume)
+    levels = np.linspace(-10, 10, 41)
+    assert np.allclose(
+        terrain.volume(levels), [numerics.volume(triple.heights, x) for x in levels]
+    )
+
+
+def test_terrain_registry():
+    registry = numerics.TerrainRegistry(max_bytes=2 * 16 * 10)
+    first = registry.get(np.arange(10))
+    assert registry.get(np.arange(10)) is first
+    # Same values, different dtype
+    assert registry.get(np.arange(10.0)) is not first
+    assert len(registry) == 2
+    registry.get(np.arange(11))
+    assert len(registry) == 1
+    assert registry.nbytes <= registry.max_bytes
+
+
+def test_dynamic_terrain(triple):
+    terrain = numerics.DynamicTerrain(triple.heights)
+    assert len(terrain) == len(triple.heights)
+    assert np.isclose(terrain.level(triple.volume), triple.level)
+    assert np.isclose(terrain.volume(triple.level), triple.volume)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_dynamic_terrain__updates(seed):
+    """Property test: `DynamicTerrain` tracks `level()` through random updates."""
+    rng = np.random.default_rng(seed)
+    heights = rng.integers(-10, 11, size=rng.integers(1, 50)).astype(np.float64)
+    terrain = numerics.DynamicTerrain(heights)
+    for _ in range(200):
+        index = rng.integers(heights.size)
+        # Mix of repeated integers (ties) and arbitrary floats
+        new_height = rng.choice([rng.integers(-10, 11), rng.normal(scale=10)])
+        heights[index] = new_height
+        terrain.update(index, new_height)
+
+        assert np.array_equal(terrain.heights, heights)
+        volume = rng.uniform(0, 100)
+        assert np.isclose(terrain.level(volume), numerics.level(heights, volume))
+        level = rng.uniform(-15, 15)
+        assert np.isclose(terrain.volume(level), numerics.volume(heights, level))
+
+
+@pytest.mark.parametrize("max_buffer", [0, 8, 2**16])
+def test_level_streaming(triple, max_buffer):
+    heights = np.asarray(triple.heights)
+    level_estimated = numerics.level_streaming(
+        heights, triple.volume, chunk_size=3, bins=4, max_buffer=max_buffer
+    )
+    assert isinstance(level_estimated, np.float64)
+    assert np.isclose(level_estimated, triple.level)
+    assert np.isclose(
+        numerics.volume_streaming(heights, triple.level, chunk_size=3), triple.volume
+    )
+
+
+def test_level_streaming__memmap(tmp_path):
+    rng = np.random.default_rng(0)
+    heights = np.lib.format.open_memmap(
+        tmp_path / "heights.npy", mode="w+", dtype=np.float64, shape=(100_000,)
+    )
+    heights[:] = rng.exponential(size=heights.size)
+    heights[::3] = 1.0  # Plenty of ties
+    heights.flush()
+    heights = np.load(tmp_path / "heights.npy", mmap_mode="r")
+
+    def chunks():
+        return (heights[i : i + 999] for i in range(0, heights.size, 999))
+
+    for volume in [0.0, 10.0, 1e4, 1e8]:
+        expected = numerics.level(heights, volume)
+        for source in [heights, chunks]:
+            assert np.isclose(
+                numerics.level_streaming(
+                    source, volume, chunk_size=4096, max_buffer=100
+                ),
+                expected,
+            )
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_level_streaming__workers(workers):
+    heights = np.random.default_rng(0).normal(size=100_000)
+    for volume in [0.0, 1.0, 1e4, 1e7]:
+        assert np.isclose(
+            numerics.level_streaming(
+                heights, volume, chunk_size=999, max_buffer=100, workers=workers
+            ),
+            numerics.level(heights, volume),
+        )
+
+
+def test_map_ahead():
+    read = []
+
+    def items():
+        for i in range(100):
+            read.append(i)
+            yield i
+
+    results = numerics._map_ahead(lambda x: 2 * x, items(), workers=3)
+    for i, result in enumerate(results):
+        assert result == 2 * i
+        # Only a bounded window of items is read ahead of the results
+        assert len(read) <= i + 1 + 2 * 3
+    assert len(read) == 100
+
+
+def test_parallel(monkeypatch, triple):
+    """With `workers`, `volume()` and `level()` agree with the serial versions."""
+    monkeypatch.setattr(numerics, "parallel_threshold", 0)
+    assert np.isclose(
+        numerics.volume(triple.heights, triple.level, workers=2), triple.volume
+    )
+    assert np.isclose(
+        numerics.level(triple.heights, triple.volume, workers=2), triple.level
+    )
+
+    rng = np.random.default_rng(0)
+    heights = rng.normal(size=100_000)
+    for volume in [0.0, 1.0, 1e4, 1e7]:
+        assert np.isclose(
+            numerics.level(heights, volume, workers=3),
+            numerics.level(heights, volume, "sort"),
+        )
+        assert np.isclose(
+            numerics.volume(heights, volume, workers=3),
+            numerics.volume(heights, volume),
+        )
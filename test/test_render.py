@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from water_filling import render
+
+
+def test_render_svg(triple):
+    svg = render.render_svg(np.asanyarray(triple.heights), np.float64(triple.level))
+    assert "http://www.w3.org/2000/svg" in svg
+    assert svg.lower().strip().endswith("</svg>")
+
+
+@pytest.mark.asyncio
+async def test_render_svg_async():
+    heights = np.asanyarray([3, 5, 6, 8, 5, 1, 3])
+    svg = await render.render_svg_async(heights, np.float64(5.5))
+    assert "http://www.w3.org/2000/svg" in svg
+    assert svg.lower().strip().endswith("</svg>")
+
+
+def test_render_svg__native(monkeypatch):
+    monkeypatch.setattr(render.options, "renderer", "native")
+    svg = render.render_svg(np.asanyarray([3, 5, 6]), np.float64(5.5))
+    assert "http://www.w3.org/2000/svg" in svg
+    assert "matplotlib" not in svg
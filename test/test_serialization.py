@@ -1,3 +1,5 @@
+import io
+
 import numpy as np
 import pytest
 
@@ -12,6 +14,8 @@ from water_filling import serialization
         ("1.5", 1.5),
         ("1.500", 1.5),
         ("3.0", 3.0),
+        ("1e5", 1e5),
+        ("2.5E-1", 0.25),
     ],
 )
 def test_parse_volume__float(s, volume):
@@ -63,6 +67,9 @@ def test_parse_volume__bad(s):
         ("3.0", [3]),
         ("3.0,", [3]),
         ("3.0," * 2**4, [3] * 2**4),
+        ("1e3,2", [1000, 2]),
+        ("-1E+3, 2", [-1000, 2]),
+        ("1e+20", [1e20]),
     ],
 )
 def test_parse_heights__float(s, heights):
@@ -97,12 +104,106 @@ def test_parse_heights__int(s, heights):
         "nan,",
         "inf",
         "3," * 2**16,
+        "1,2,asdf",
+        "1,,2",
+        "1 2",
+        "1_000",
+        "\u0661",
+        "1,2.5e",
+        "99999999999999999999",
     ],
 )
 def test_parse_heights__bad(s):
     assert serialization.parse_heights(s) is None
 
 
+@pytest.mark.parametrize("dtype", ["float64", "int64"])
+def test_parse_heights_binary(dtype):
+    heights = np.array([-1, 2, -3, 4], dtype="<" + np.dtype(dtype).str[1:])
+    parsed = serialization.parse_heights_binary(heights.tobytes(), dtype)
+    assert parsed.dtype == np.dtype(dtype)
+    assert np.all(heights == parsed)
+    # Views the body without copying
+    body = bytearray(heights.tobytes())
+    parsed = serialization.parse_heights_binary(body, dtype)
+    body[:8] = np.array([5], dtype=dtype).tobytes()
+    assert parsed[0] == 5
+
+
+@pytest.mark.parametrize(
+    "body,dtype",
+    [
+        (b"", "float64"),
+        (b"\0" * 12, "float64"),
+        (np.array([1.0, np.nan]).tobytes(), "float64"),
+        (np.zeros(4).tobytes(), "float32"),
+    ],
+)
+def test_parse_heights_binary__bad(body, dtype):
+    assert serialization.parse_heights_binary(body, dtype) is None
+
+
+@pytest.mark.parametrize(
+    "heights", [np.arange(4), np.linspace(-1, 1, 5), np.arange(4, dtype=">f8")]
+)
+def test_parse_heights_npy(heights):
+    stream = io.BytesIO()
+    np.save(stream, heights)
+    parsed = serialization.parse_heights_npy(stream.getvalue())
+    assert parsed.dtype.isnative
+    assert np.all(heights == parsed)
+
+
+@pytest.mark.parametrize(
+    "heights", [np.arange(4, dtype=np.int8), np.zeros((2, 2)), np.array(["a"])]
+)
+def test_parse_heights_npy__bad(heights):
+    stream = io.BytesIO()
+    np.save(stream, heights)
+    assert serialization.parse_heights_npy(stream.getvalue()) is None
+    assert serialization.parse_heights_npy(b"not npy") is None
+
+
+def test_parse_heights_npy__malformed_header():
+    stream = io.BytesIO()
+    np.save(stream, np.arange(3.0))
+    body = stream.getvalue()
+    truncated = body.replace(b"(3,), }", b"(3, }   ")
+    assert truncated != body
+    assert serialization.parse_heights_npy(truncated) is None
+
+
+@pytest.mark.parametrize(
+    "body,heights",
+    [
+        ("[1, 2, 3]", [1, 2, 3]),
+        ("[1, 2.5, -3]", [1, 2.5, -3]),
+    ],
+)
+def test_parse_heights_json(body, heights):
+    parsed = serialization.parse_heights_json(body)
+    assert parsed.dtype == (np.float64 if "." in body else np.int_)
+    assert np.all(heights == parsed)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        "",
+        "[]",
+        "{}",
+        '["1"]',
+        "[1, [2]]",
+        "[true]",
+        "[NaN]",
+        "[1e400]",
+        pytest.param("[" * 50000, id="nested"),
+    ],
+)
+def test_parse_heights_json__bad(body):
+    assert serialization.parse_heights_json(body) is None
+
+
 @pytest.mark.parametrize(
     "vec,s",
     [
@@ -0,0 +1,72 @@
+import json
+
+import numpy as np
+import pytest
+
+from water_filling import database, interface, snapshot
+from water_filling.bench import Bench
+
+variants = interface.content_types
+
+
+def entry(i):
+    return {variant: f"<p>{i}</p>" for variant in variants}
+
+
+@pytest.mark.asyncio
+async def test_snapshot(mock_db, monkeypatch, tmp_path):
+    path = tmp_path / "snapshot.json"
+    instances = [(np.arange(4), np.int_(v)) for v in range(3)]
+    for heights, volume in instances:
+        await database.fulfill_as_json_serializable_with_cache_async(heights, volume)
+    database.writer.flush()
+    bench = Bench(None)
+    bench.entries.extend([entry(1), entry(2)])
+    snapshot.save(snapshot.state(bench, "v1"), path)
+
+    # After a restart
+    memory = database.MemoryCache(2**20)
+    monkeypatch.setattr(database, "memory", memory)
+    bench2 = Bench(None)
+    assert snapshot.load(bench2, "v1", variants, path)
+    assert list(bench2.entries) == list(bench.entries)
+    assert memory.recent_keys() == [
+        database.digest(heights, volume) for heights, volume in instances[::-1]
+    ]
+    res = await database.fulfill_as_json_serializable_with_cache_async(*instances[0])
+    assert res["cached"] is True
+    assert memory.stats["hits"] == 1
+
+    # Bench entries rendered with other templates are dropped
+    bench3 = Bench(None)
+    assert snapshot.load(bench3, "v2", variants, path)
+    assert not bench3.entries
+
+
+def test_snapshot__missing_or_corrupt(tmp_path):
+    path = tmp_path / "snapshot.json"
+    assert not snapshot.load(Bench(None), "v1", variants, path)
+    path.write_text("{")
+    assert not snapshot.load(Bench(None), "v1", variants, path)
+    path.write_text(json.dumps({"version": "v1", "bench": [], "hot_keys": []}))
+    assert snapshot.load(Bench(None), "v1", variants, path)
+
+
+@pytest.mark.parametrize(
+    "state",
+    [
+        [],
+        {"version": "v1", "hot_keys": []},
+        {"version": "v1", "bench": [["<p>1</p>"]], "hot_keys": []},
+        {"version": "v1", "bench": [{"html": "<p>1</p>"}], "hot_keys": []},
+        {"version": "v1", "bench": [{**entry(1), "xml": "<p/>"}], "hot_keys": []},
+        {"version": "v1", "bench": [], "hot_keys": ["not hex"]},
+        {"version": "v1", "bench": [], "hot_keys": [1]},
+    ],
+)
+def test_snapshot__malformed(tmp_path, state):
+    path = tmp_path / "snapshot.json"
+    path.write_text(json.dumps(state))
+    bench = Bench(None)
+    assert not snapshot.load(bench, "v1", variants, path)
+    assert not bench.entries
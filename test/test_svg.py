@@ -0,0 +1,27 @@
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from water_filling import colors, svg
+
+
+def test_render(triple):
+    svg_data = svg.render(triple.heights, triple.level)
+    assert "http://www.w3.org/2000/svg" in svg_data
+    assert svg_data.lower().strip().endswith("</svg>")
+    root = ET.fromstring(svg_data.encode())
+    assert root.tag == "{http://www.w3.org/2000/svg}svg"
+    for color in colors.colors["water"], colors.colors["terrain"]:
+        assert color in svg_data
+
+
+def test_render__terrain_is_single_path():
+    heights = np.arange(1000)
+    svg_data = svg.render(heights, np.float64(500))
+    root = ET.fromstring(svg_data.encode())
+    fills = [
+        path.get("fill")
+        for path in root.iter("{http://www.w3.org/2000/svg}path")
+        if path.get("fill") == colors.colors["terrain"]
+    ]
+    assert len(fills) == 1
@@ -1,6 +1,9 @@
 import asyncio
+import contextlib
 
 from .interface import main
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Raised once `main()` has shut down on SIGTERM
+    with contextlib.suppress(asyncio.CancelledError):
+        asyncio.run(main())
@@ -0,0 +1,83 @@
+"""Pool of pregenerated responses for random instances."""
+
+import asyncio
+import math
+import time
+from collections import Counter, deque
+
+
+class Bench:
+    """Pool of entries made ahead of demand by an async `produce()` function.
+
+    The pool is sized from the rate at which entries were taken over the last
+    `horizon` seconds: it is refilled up to a high watermark of that many
+    entries (within `min_size` and `max_size`), once it drops below a low
+    watermark of half as many. Refills are triggered by `pop()` rather than on
+    a timer, and run `concurrency` calls of `produce()` at a time, so that the
+    render workers are kept busy.
+
+    `run()` must be running for the pool to be filled.
+    """
+
+    def __init__(self, produce, min_size=4, max_size=256, horizon=10.0, concurrency=2):
+        self.entries = deque()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.horizon = horizon
+        self.concurrency = concurrency
+        self.stats = Counter(served=0, underflows=0, produced=0)
+        self._produce = produce
+        self._pops = deque()
+        self._wanted = asyncio.Event()
+        self._wanted.set()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def rate(self):
+        """Entries requested per second over the last `horizon` seconds."""
+        while self._pops and self._pops[0] < time.monotonic() - self.horizon:
+            self._pops.popleft()
+        return len(self._pops) / self.horizon
+
+    def high_watermark(self):
+        high = math.ceil(self.rate() * self.horizon)
+        return min(max(high, self.min_size), self.max_size)
+
+    def low_watermark(self):
+        return self.high_watermark() // 2
+
+    def pop(self):
+        """Take an entry, or return `None` if there are none left."""
+        self._pops.append(time.monotonic())
+        if self.entries:
+            self.stats["served"] += 1
+            entry = self.entries.popleft()
+        else:
+            self.stats["underflows"] += 1
+            entry = None
+        if len(self.entries) < self.low_watermark():
+            self._wanted.set()
+        return entry
+
+    async def run(self):
+        """Fill the pool whenever it runs low, forever."""
+        while True:
+            await self._wanted.wait()
+            self._wanted.clear()
+            while (shortfall := self.high_watermark() - len(self.entries)) > 0:
+                entries = await asyncio.gather(
+                    *(self._produce() for _ in range(min(shortfall, self.concurrency)))
+                )
+                self.entries.extend(entries)
+                self.stats["produced"] += len(entries)
+
+    def report(self):
+        """Depth, watermarks and counters, for monitoring."""
+        return {
+            "depth": len(self.entries),
+            "low_watermark": self.low_watermark(),
+            "high_watermark": self.high_watermark(),
+            "rate": self.rate(),
+            **self.stats,
+        }
@@ -0,0 +1,79 @@
+"""Negotiated compression of response bodies."""
+
+import gzip
+import zlib
+from functools import partial
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content codings we can produce, by their names in `Accept-Encoding`
+encoders = {
+    "gzip": partial(gzip.compress, compresslevel=6, mtime=0),
+    "deflate": zlib.compress,
+}
+if brotli is not None:
+    encoders = {"br": partial(brotli.compress, quality=5), **encoders}
+
+compressible_types = ("text/", "image/svg", "application/json", "application/x-ndjson")
+
+
+def streamed(response):
+    """Whether the body of `response` is an async generator."""
+    return hasattr(response.body, "__anext__")
+
+
+def compressible(response, min_bytes):
+    """Whether `response` is worth compressing.
+
+    Only bodies of text, SVG, JSON or NDJSON that are not compressed yet
+    qualify, and only if they are streamed or of at least `min_bytes` bytes.
+    """
+    return (
+        response.status_code == 200
+        and "Content-Encoding" not in response.headers
+        and response.headers.get("Content-Type", "").startswith(compressible_types)
+        and (
+            streamed(response)
+            or isinstance(response.body, bytes)
+            and len(response.body) >= min_bytes
+        )
+    )
+
+
+def compressor(coding):
+    """Function compressing one piece of a stream after another.
+
+    Each piece is flushed, so that what has been streamed so far can be
+    decompressed right away. Call with `None` to finish the stream.
+    """
+    if coding == "br":
+        brotli_compressor = brotli.Compressor(quality=5)
+
+        def compress(data):
+            if data is None:
+                return brotli_compressor.finish()
+            return brotli_compressor.process(data) + brotli_compressor.flush()
+
+        return compress
+
+    wbits = {"gzip": 31, "deflate": 15}[coding]
+    zlib_compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+
+    def compress(data):
+        if data is None:
+            return zlib_compressor.flush()
+        return zlib_compressor.compress(data) + zlib_compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    return compress
+
+
+async def compress_stream(chunks, coding):
+    """Compress the async iterable `chunks` of bytes with `coding`, piecewise."""
+    compress = compressor(coding)
+    async for chunk in chunks:
+        if data := compress(chunk):
+            yield data
+    yield compress(None)
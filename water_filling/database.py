@@ -1,75 +1,830 @@
 """Caching logic between the interface and math."""
 
-import io
+import asyncio
+import atexit
+import functools
+import gzip
+import hashlib
+import lzma
+import queue
 import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 
-import matplotlib
 import numpy as np
 
-from water_filling import numerics, serialization
-from water_filling.visualize import visualize
+from water_filling import numerics, render, serialization
+from water_filling.options import get_options
+
+options = get_options()
+
+# Compression of SVGs stored in the cache, as {name: (compress, decompress)}.
+# SVG is repetitive text, so the smaller cache is usually worth the CPU.
+codecs = {
+    "identity": (bytes, bytes),
+    "gzip": (functools.partial(gzip.compress, mtime=0), gzip.decompress),
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+# HTTP content codings that can be sent without recoding, with their codecs
+content_codings = {"gzip": "gzip", "deflate": "zlib"}
+
+
+def connect(path):
+    """Open the cache database at `path`, tune it, and bring its schema current."""
+    con = sqlite3.connect(path)
+    if con.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Needed by `evict_async()`; takes effect on a new database right away, but
+        # an existing one has to be rebuilt once
+        con.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        con.execute("VACUUM")
+    con.execute("PRAGMA journal_mode = WAL")
+    con.execute("PRAGMA synchronous = NORMAL")
+    con.execute("PRAGMA temp_store = MEMORY")
+    con.execute("PRAGMA cache_size = -65536")  # KiB
+    con.execute(f"PRAGMA mmap_size = {2**28}")
+    migrate(con)
+    return con
+
+
+def migrate(con):
+    """Apply the migrations that are newer than the database's `user_version`."""
+    (version,) = con.execute("PRAGMA user_version").fetchone()
+    for new_version, migration in enumerate(migrations[version:], start=version + 1):
+        con.execute("BEGIN")
+        try:
+            migration(con)
+            con.execute(f"PRAGMA user_version = {new_version}")
+        except BaseException:
+            con.rollback()
+            raise
+        con.commit()
+
+
+def migrate_to_v1(con):
+    """Key rows by `digest()` instead of scanning the heights and volume.
+
+    The unversioned `water_filling` table stored the raw bytes of the heights
+    and volume but not their dtypes. Each row is carried over with whichever
+    interpretation as `np.int_` or `np.float64` reproduces its level; rows that
+    no interpretation fits are dropped.
+    """
+    con.execute("""
+    CREATE TABLE solutions (
+        key BLOB PRIMARY KEY,
+        heights BLOB NOT NULL,
+        heights_dtype TEXT NOT NULL,
+        volume BLOB NOT NULL,
+        volume_dtype TEXT NOT NULL,
+        level REAL NOT NULL,
+        svg TEXT
+    ) STRICT
+    """)
+
+    if not con.execute(
+        "SELECT 1 FROM sqlite_schema WHERE type='table' AND name='water_filling'"
+    ).fetchone():
+        return
+
+    for heights_bytes, volume_bytes, level, svg_data in con.execute(
+        "SELECT heights, volume, level, svg FROM water_filling"
+    ).fetchall():
+        if parsed := _parse_legacy_row(heights_bytes, volume_bytes, level):
+            heights, volume = parsed
+            con.execute(
+                "INSERT OR IGNORE INTO solutions VALUES (?,?,?,?,?,?,?)",
+                (
+                    digest(heights, volume),
+                    heights_bytes,
+                    heights.dtype.str,
+                    volume_bytes,
+                    volume.dtype.str,
+                    level,
+                    svg_data,
+                ),
+            )
+    con.execute("DROP TABLE water_filling")
+
+
+def _parse_legacy_row(heights_bytes, volume_bytes, level):
+    """Recover `(heights, volume)` from an unversioned row, or return `None`."""
+    dtypes = [np.dtype(np.int_), np.dtype(np.float64)]
+    for heights_dtype in dtypes:
+        for volume_dtype in dtypes:
+            heights = np.frombuffer(heights_bytes, heights_dtype)
+            volume = np.frombuffer(volume_bytes, volume_dtype)
+            if heights.size == 0 or volume.size != 1:
+                continue
+            volume = volume[0]
+            with np.errstate(all="ignore"):
+                if (
+                    np.isfinite(heights).all()
+                    and 0 <= volume < np.inf
+                    and np.isclose(numerics.level(heights, volume), level)
+                ):
+                    return heights, volume
+    return None
+
+
+def migrate_to_v2(con):
+    """Track creation and access times, hit counts and sizes for `evict_async()`."""
+    now = time.time()
+    for column in [
+        f"created_at REAL NOT NULL DEFAULT {now}",
+        f"accessed_at REAL NOT NULL DEFAULT {now}",
+        "hits INTEGER NOT NULL DEFAULT 0",
+        "size INTEGER NOT NULL DEFAULT 0",
+    ]:
+        con.execute(f"ALTER TABLE solutions ADD COLUMN {column}")
+    con.execute("""
+    UPDATE solutions
+    SET size = length(heights) + length(volume) + coalesce(length(svg), 0)
+    """)
+    con.execute("CREATE INDEX solutions_created_at ON solutions (created_at)")
+
+
+def migrate_to_v3(con):
+    """Store SVGs compressed, together with the name of the codec used."""
+    con.execute("ALTER TABLE solutions ADD COLUMN svg_encoded BLOB")
+    con.execute("ALTER TABLE solutions ADD COLUMN svg_codec TEXT")
+    for key, svg_data in con.execute(
+        "SELECT key, svg FROM solutions WHERE svg IS NOT NULL"
+    ).fetchall():
+        svg_encoded = encode_svg(svg_data, "gzip")
+        con.execute(
+            """
+            UPDATE solutions
+            SET svg_encoded = ?, svg_codec = 'gzip', size = size - ? + ?
+            WHERE key = ?
+            """,
+            (svg_encoded, len(svg_data), len(svg_encoded), key),
+        )
+    con.execute("ALTER TABLE solutions DROP COLUMN svg")
+
+
+def migrate_to_v4(con):
+    """Add a cache of levels keyed by `canonical_digest()`."""
+    con.execute(
+        """
+        CREATE TABLE levels (
+            key BLOB PRIMARY KEY,
+            level REAL NOT NULL,
+            created_at REAL NOT NULL
+        ) STRICT
+        """
+    )
+    con.execute("CREATE INDEX levels_created_at ON levels (created_at)")
+
+
+migrations = [migrate_to_v1, migrate_to_v2, migrate_to_v3, migrate_to_v4]
+
+
+def encode_svg(svg_data, codec):
+    compress, _ = codecs[codec]
+    return compress(svg_data.encode())
+
+
+def decode_svg(svg_encoded, codec):
+    _, decompress = codecs[codec]
+    return decompress(svg_encoded).decode()
+
+
+def digest(heights, volume):
+    """Fixed-size cache key for a problem instance."""
+    key = hashlib.blake2b(digest_size=16)
+    for arr in np.ascontiguousarray(heights), np.asanyarray(volume):
+        key.update(arr.dtype.str.encode())
+        key.update(arr.tobytes())
+    return key.digest()
+
+
+def canonical_digest(heights, volume):
+    """Cache key for the level of a problem instance, and the shift to apply.
+
+    The level only depends on the multiset of heights, and shifting all heights
+    by a constant shifts the level by the same constant. So the key is computed
+    from the sorted float64 heights minus their minimum, and the float64 volume,
+    and the level cached under it must be shifted back by that minimum. This way
+    `"1,2,3"`, `"3.0,1,2"` and `"11,12,13"` share a cached level.
+    """
+    work = np.sort(np.asarray(heights, dtype=np.float64))
+    shift = work[0]
+    work -= shift
+    key = hashlib.blake2b(work.tobytes(), digest_size=16)
+    key.update(np.float64(volume).tobytes())
+    return key.digest(), shift
+
+
+class Writer:
+    """Thread that applies all writes to the disk cache, in group commits.
+
+    Operations are functions taking a connection as their first argument. They
+    are queued by `submit()` and run in batches: after the first operation of a
+    batch arrives, the thread waits up to `linger` seconds for more, then
+    applies them all in one transaction, so that many writes share one commit.
+
+    Solutions submitted for storage but not yet committed are available in
+    `pending`, as `{key: (level, svg_data)}`, so that readers can see them.
+    Changes to `pending` must hold `pending_lock`, as they are made both from
+    the event loop and from the thread.
+    """
+
+    def __init__(self, path, linger=0.005):
+        self.path = path
+        self.linger = linger
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, name="cache-writer", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, op, *args):
+        """Queue `op(con, *args)`; the future resolves once it is committed."""
+        future = Future()
+        self._queue.put((future, op, args))
+        return future
+
+    def flush(self):
+        """Block until everything submitted so far has been committed."""
+        self.submit(lambda con: None).result()
+
+    def close(self):
+        """Commit everything submitted so far and stop the thread."""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        con = sqlite3.connect(self.path, isolation_level=None)
+        con.execute("PRAGMA synchronous = NORMAL")
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.linger
+            while batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get(timeout=deadline - time.monotonic()))
+                except (queue.Empty, ValueError):
+                    break
+
+            results = []
+            con.execute("BEGIN")
+            for future, op, args in filter(None, batch):
+                # Savepoints keep a failing operation from spoiling the batch
+                con.execute("SAVEPOINT op")
+                try:
+                    results.append((future, op(con, *args), None))
+                    con.execute("RELEASE op")
+                except Exception as exc:  # noqa: BLE001 - the future reraises it
+                    con.execute("ROLLBACK TO op")
+                    con.execute("RELEASE op")
+                    results.append((future, None, exc))
+            try:
+                con.execute("COMMIT")
+            except sqlite3.Error as exc:
+                con.execute("ROLLBACK")
+                results = [(future, None, exc) for future, _, _ in results]
+
+            for future, result, exc in results:
+                if exc is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exc)
+            if batch[-1] is None:
+                con.close()
+                return
+
+
+class Readers:
+    """Pool of threads with read-only connections to the disk cache."""
+
+    def __init__(self, path, workers=4):
+        self.path = Path(path)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="cache-reader")
+        self._local = threading.local()
+
+    def _connection(self):
+        if (con := getattr(self._local, "con", None)) is None:
+            con = sqlite3.connect(f"{self.path.as_uri()}?mode=ro", uri=True)
+            self._local.con = con
+        return con
+
+    def _call(self, op, *args):
+        return op(self._connection(), *args)
+
+    async def run(self, op, *args):
+        """Await `op(con, *args)` run on one of the threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, op, *args)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class MemoryCache:
+    """Thread-safe LRU cache of solution dicts, bounded by memory use.
+
+    This sits in front of the disk cache, so that the solutions asked for most
+    often are served without touching the disk or building the dict again.
+    Dicts are copied on the way in and out, so callers may modify them. Hits,
+    misses and evictions are counted in `stats`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.stats = Counter(hits=0, misses=0, evictions=0)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def recent_keys(self):
+        """The keys of the cached dicts, most recently used first."""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    @staticmethod
+    def size(as_dict):
+        """Approximate memory use in bytes of a solution dict."""
+        size = sys.getsizeof(as_dict)
+        for value in as_dict.values():
+            size += sys.getsizeof(value)
+        # Elements of the heights list, assuming small ints or floats
+        return size + 32 * len(as_dict["heights"])
+
+    def get(self, key, include_svg=True):
+        """The solution dict under `key`, or `None` if it is missing.
+
+        Entries without the SVG only count as hits if `include_svg` is false.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (include_svg and entry[0]["svg"] is None):
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        return dict(entry[0], cached=True)
+
+    def put(self, key, as_dict):
+        """Cache `as_dict`, replacing any entry under `key`."""
+        size = self.size(as_dict)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if (old := self._entries.pop(key, None)) is not None:
+                self.nbytes -= old[1]
+            self._entries[key] = (dict(as_dict), size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.stats["evictions"] += 1
+
 
 cache_path = Path.home() / ".cache" / "water_filling.cache.db"
 cache_path.parent.mkdir(parents=True, exist_ok=True)
 
-con = sqlite3.connect(cache_path)
+# Connection that brings the schema current, and that `warm_memory()` reads
+# through before the server starts. Everything else reads through `readers` and
+# writes through `writer`, to stay off the event loop.
+con = connect(cache_path)
+writer = Writer(cache_path)
+readers = Readers(cache_path, options.cache_readers)
+
+# Cache hits not yet written to the database, as {key: [accessed_at, hits]}.
+# Recording every hit with its own UPDATE would turn reads into writes.
+accesses = {}
+accesses_lock = threading.Lock()
+
+memory = MemoryCache(options.memory_cache_bytes)
+disk_stats = Counter(hits=0, misses=0, evictions=0)
+level_stats = Counter(hits=0, misses=0)
+
+# Solutions being computed by `fulfill_as_json_serializable_with_cache_async()`,
+# as {(key, include_svg): task}, and how many requests waited on one of them
+# instead of computing the solution again.
+inflight = {}
+inflight_stats = Counter(coalesced=0)
+
 
+def stats():
+    """Hits, misses and evictions of the memory and disk cache tiers."""
+    return {
+        "memory": {**memory.stats, "entries": len(memory), "bytes": memory.nbytes},
+        "disk": dict(disk_stats),
+        "levels": dict(level_stats),
+        "inflight": {**inflight_stats, "pending": len(inflight)},
+    }
 
-def fulfill_as_json_serializable_skip_cache(heights, volume):
+
+def close():
+    """Write out everything pending and close the disk cache."""
+    flush_accesses()
+    writer.close()
+    readers.close()
+    con.close()
+
+
+def fulfill_as_json_serializable_skip_cache(heights, volume, include_svg=True):
     """Compute JSON-serializable dict with solution for given problem params.
 
     Assumes `heights` and `volume` have been parsed as NumPy types (array and
     scalar).
 
     The returned dictionary can be forwarded to fulfill JSON requests or
-    unpacked to populate the `visualize.html` template.
+    unpacked to populate the `visualize.html` template. Rendering the SVG costs
+    much more than computing the level, so if `include_svg` is false, it is
+    skipped and the `"svg"` entry is `None`.
     """
-    matplotlib.use("svg")  # Allows starting in non-main thread
-    level = numerics.level(heights, volume)
-    fig, ax = visualize(heights, level)
-    with io.StringIO() as buf:
-        fig.savefig(buf, format="svg", transparent=True, bbox_inches="tight")
-        svg_data = buf.getvalue()
+    level = numerics.terrains.get(heights).level(volume)
+    svg_data = render.render_svg(heights, level) if include_svg else None
+    return serialization.to_json_serializable_dict(heights, volume, level, svg_data)
+
 
+async def fulfill_as_json_serializable_skip_cache_async(
+    heights, volume, include_svg=True
+):
+    """Like `fulfill_as_json_serializable_skip_cache()`, for the event loop.
+
+    The SVG is rendered with `render.render_svg_async()`.
+    """
+    level = numerics.terrains.get(heights).level(volume)
+    svg_data = await render.render_svg_async(heights, level) if include_svg else None
     return serialization.to_json_serializable_dict(heights, volume, level, svg_data)
 
 
-def fulfill_as_json_serializable_with_cache(heights, volume):
+async def fulfill_as_json_serializable_with_cache_async(
+    heights, volume, include_svg=True
+):
     """Retrieve JSON-serializable dict with solution for given problem params.
 
-    Wraps `fulfill_as_json_serializable_skip_cache()` with a sqlite3 disk cache.
+    Wraps `fulfill_as_json_serializable_skip_cache_async()` with a sqlite3 disk
+    cache, in front of which `memory` keeps the most recently used solution
+    dicts. The level and the SVG are cached independently: a row may hold just
+    the level, and its SVG is rendered and added the first time it is needed.
+    When there is no row, the level may still be found by `canonical_digest()`,
+    from an equivalent instance.
+
+    Reads and writes go through `readers` and `writer`, so the event loop never
+    waits on the disk; writes are not awaited at all.
+
+    Concurrent calls for the same solution share a single computation: the
+    first one to miss the memory cache starts it, and the others wait for it.
+    """
+    key = digest(heights, volume)
+    if as_dict := memory.get(key, include_svg):
+        record_access(key)
+        return as_dict
+
+    flight = (key, include_svg)
+    if (task := inflight.get(flight)) is None:
+        task = asyncio.ensure_future(_fulfill_async(key, heights, volume, include_svg))
+        inflight[flight] = task
+        task.add_done_callback(lambda _: inflight.pop(flight, None))
+    else:
+        inflight_stats["coalesced"] += 1
+    # Shielded so that a cancelled request does not cancel the others' task
+    return dict(await asyncio.shield(task))
+
+
+async def _fulfill_async(key, heights, volume, include_svg):
+    if as_dict := await fetch_async(key, heights, volume):
+        if include_svg and as_dict["svg"] is None:
+            as_dict["svg"] = await render.render_svg_async(
+                heights, np.float64(as_dict["level"])
+            )
+            as_dict["cached"] = False
+            store_svg_async(key, as_dict["level"], as_dict["svg"])
+        memory.put(key, as_dict)
+        return as_dict
+
+    canonical_key, shift = canonical_digest(heights, volume)
+    if (level := await readers.run(_select_level, canonical_key)) is not None:
+        level_stats["hits"] += 1
+        level = np.float64(level + shift)
+    else:
+        level_stats["misses"] += 1
+        level = numerics.terrains.get(heights).level(volume)
+        writer.submit(_insert_level, canonical_key, level - shift)
+    svg_data = await render.render_svg_async(heights, level) if include_svg else None
+    as_dict = serialization.to_json_serializable_dict(heights, volume, level, svg_data)
+    store_async(key, heights, volume, as_dict)
+    memory.put(key, as_dict)
+    return as_dict
+
+
+def warm_memory(keys):
+    """Load the solutions under `keys` from disk into `memory`.
+
+    `keys` are in the order of `MemoryCache.recent_keys()`, which is preserved. Use
+    this to bring back the hottest solutions after a restart. Returns how many
+    were found.
+    """
+    loaded = 0
+    for key in reversed(list(keys)):
+        if (row := _select_instance(con, key)) is None:
+            continue
+        heights, volume, (level, svg_data) = row
+        as_dict = serialization.to_json_serializable_dict(
+            heights, volume, np.float64(level), svg_data
+        )
+        memory.put(key, as_dict)
+        loaded += 1
+    return loaded
+
+
+async def fetch_async(key, heights, volume):
+    """Look up the solution dict under `key` in the disk cache, or return `None`.
+
+    The `"svg"` entry of the result is `None` if only the level was cached.
+    """
+    if (fetched := writer.pending.get(key)) is None:
+        fetched = await readers.run(_select, key)
+    return _to_dict(key, heights, volume, fetched)
+
+
+async def fetch_svg_encoded_async(key, codec):
+    """The SVG under `key` if the disk cache holds it compressed with `codec`.
+
+    This lets the SVG be sent with a matching `Content-Encoding` without
+    decompressing it. Returns `None` otherwise.
+    """
+    if (svg_encoded := await readers.run(_select_svg_encoded, key, codec)) is not None:
+        record_access(key)
+    return svg_encoded
+
+
+def store_async(key, heights, volume, as_dict):
+    """Have `writer` save the solution dict computed for `heights` and `volume`."""
+    return _submit_pending(
+        key,
+        (as_dict["level"], as_dict["svg"]),
+        _insert,
+        key,
+        heights,
+        volume,
+        as_dict["level"],
+        as_dict["svg"],
+    )
+
+
+def store_svg_async(key, level, svg_data):
+    """Have `writer` add the SVG to a row that so far only has the level."""
+    return _submit_pending(key, (level, svg_data), _update_svg, key, svg_data)
+
+
+def record_access(key):
+    """Note a cache hit, to be written to disk by `flush_accesses()`."""
+    now = time.time()
+    with accesses_lock:
+        if (access := accesses.get(key)) is None:
+            accesses[key] = [now, 1]
+        else:
+            access[0] = now
+            access[1] += 1
+
+
+def _take_accesses():
+    with accesses_lock:
+        pending = [
+            (accessed_at, hits, key) for key, (accessed_at, hits) in accesses.items()
+        ]
+        accesses.clear()
+    return pending
+
+
+def flush_accesses():
+    """Have `writer` write the cache hits noted by `record_access()`."""
+    return writer.submit(_update_accesses, _take_accesses())
+
+
+eviction_orders = {
+    "lru": "accessed_at DESC",
+    "lfu": "hits DESC, accessed_at DESC",
+}
+
+
+async def evict_async(max_rows=None, max_bytes=None, ttl=None, policy="lru"):
+    """Delete rows from the disk cache to respect the given limits.
+
+    Rows created more than `ttl` seconds ago are deleted. Then, if more than
+    `max_rows` rows or `max_bytes` bytes remain, rows are deleted in order of
+    least recent access (`policy="lru"`) or fewest hits (`policy="lfu"`) until
+    the limits are met. The cached levels are held to the same `ttl` and
+    `max_rows`, oldest first. Finally, the freed pages are returned to the
+    filesystem.
+
+    Returns the number of solutions deleted.
     """
+    flush_accesses()
+    deleted = await asyncio.wrap_future(
+        writer.submit(_evict, max_rows, max_bytes, ttl, policy)
+    )
+    disk_stats["evictions"] += deleted
+    return deleted
+
+
+def _submit_pending(key, solution, op, *args):
+    """Submit a write of `solution` to `writer`, visible in `pending` meanwhile."""
+    with writer.pending_lock:
+        entry = writer.pending[key] = solution
+
+    def done(future):
+        # Runs on the writer thread; a newer solution under `key` must stay
+        with writer.pending_lock:
+            if writer.pending.get(key) is entry:
+                del writer.pending[key]
+
+    future = writer.submit(op, *args)
+    future.add_done_callback(done)
+    return future
+
+
+def _to_dict(key, heights, volume, fetched):
+    """Build the solution dict from the `(level, svg_data)` found in the cache."""
     assert isinstance(heights, np.ndarray)
     assert isinstance(volume, np.floating) or isinstance(volume, np.integer)
+    if fetched is None:
+        disk_stats["misses"] += 1
+        return None
+    disk_stats["hits"] += 1
+    record_access(key)
+    level, svg_data = fetched
+    as_dict = serialization.to_json_serializable_dict(
+        heights, volume, np.float64(level), svg_data
+    )
+    as_dict["cached"] = True
+    return as_dict
+
+
+# The functions below run SQL on a given connection, leaving transactions to the
+# caller, so that they work as operations for `Writer` and `Readers`.
+
+
+def _select(con, key):
+    if (fetched := writer.pending.get(key)) is not None:
+        return fetched
+    if fetched := con.execute(
+        "SELECT level, svg_encoded, svg_codec FROM solutions WHERE key=?", (key,)
+    ).fetchone():
+        level, svg_encoded, svg_codec = fetched
+        svg_data = None if svg_encoded is None else decode_svg(svg_encoded, svg_codec)
+        return level, svg_data
+    return None
+
+
+def _select_instance(con, key):
+    if fetched := con.execute(
+        """
+        SELECT heights, heights_dtype, volume, volume_dtype, level, svg_encoded,
+            svg_codec
+        FROM solutions WHERE key=?
+        """,
+        (key,),
+    ).fetchone():
+        heights, heights_dtype, volume, volume_dtype, level, svg_encoded, codec = (
+            fetched
+        )
+        svg_data = None if svg_encoded is None else decode_svg(svg_encoded, codec)
+        return (
+            np.frombuffer(heights, dtype=heights_dtype),
+            np.frombuffer(volume, dtype=volume_dtype)[0],
+            (level, svg_data),
+        )
+    return None
+
+
+def _select_svg_encoded(con, key, codec):
+    if fetched := con.execute(
+        "SELECT svg_encoded FROM solutions WHERE key=? AND svg_codec=?",
+        (key, codec),
+    ).fetchone():
+        return fetched[0]
+    return None
+
+
+def _insert(con, key, heights, volume, level, svg_data):
     heights_bytes = heights.tobytes()
     volume_bytes = volume.tobytes()
+    if svg_data is None:
+        svg_encoded = svg_codec = None
+    else:
+        svg_codec = options.cache_codec
+        svg_encoded = encode_svg(svg_data, svg_codec)
+    size = len(heights_bytes) + len(volume_bytes) + len(svg_encoded or b"")
+    now = time.time()
+    con.execute(
+        """
+        INSERT INTO solutions
+            (key, heights, heights_dtype, volume, volume_dtype, level,
+             svg_encoded, svg_codec, created_at, accessed_at, size)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT (key) DO UPDATE SET
+            svg_encoded = coalesce(svg_encoded, excluded.svg_encoded),
+            svg_codec = coalesce(svg_codec, excluded.svg_codec),
+            size = max(size, excluded.size)
+        """,
+        (
+            key,
+            heights_bytes,
+            heights.dtype.str,
+            volume_bytes,
+            volume.dtype.str,
+            level,
+            svg_encoded,
+            svg_codec,
+            now,
+            now,
+            size,
+        ),
+    )
 
-    con.execute("""
-    CREATE TABLE IF NOT EXISTS water_filling (
-        heights BLOB,
-        volume BLOB,
-        level REAL,
-        svg TEXT
-    ) STRICT
-    """)
+
+def _select_level(con, key):
     if fetched := con.execute(
-        "SELECT level, svg FROM water_filling WHERE heights=? AND volume=?",
-        (heights_bytes, volume_bytes),
+        "SELECT level FROM levels WHERE key=?", (key,)
     ).fetchone():
-        level = np.float64(fetched[0])
-        svg_data = fetched[1]
-        as_dict = serialization.to_json_serializable_dict(
-            heights, volume, level, svg_data
-        )
-        as_dict["cached"] = True
-        return as_dict
+        return fetched[0]
+    return None
+
+
+def _insert_level(con, key, level):
+    con.execute(
+        "INSERT OR IGNORE INTO levels (key, level, created_at) VALUES (?,?,?)",
+        (key, level, time.time()),
+    )
 
-    as_dict = fulfill_as_json_serializable_skip_cache(heights, volume)
 
-    with con:
+def _update_svg(con, key, svg_data):
+    svg_encoded = encode_svg(svg_data, options.cache_codec)
+    con.execute(
+        """
+        UPDATE solutions SET svg_encoded=?, svg_codec=?, size=size+?
+        WHERE key=? AND svg_encoded IS NULL
+        """,
+        (svg_encoded, options.cache_codec, len(svg_encoded), key),
+    )
+
+
+def _update_accesses(con, pending):
+    con.executemany(
+        """
+        UPDATE solutions
+        SET accessed_at = max(accessed_at, ?), hits = hits + ?
+        WHERE key = ?
+        """,
+        pending,
+    )
+
+
+def _evict(con, max_rows, max_bytes, ttl, policy):
+    order = eviction_orders[policy]
+    deleted = 0
+    if ttl is not None:
+        deleted += con.execute(
+            "DELETE FROM solutions WHERE created_at < ?", (time.time() - ttl,)
+        ).rowcount
+    if max_rows is not None or max_bytes is not None:
+        deleted += con.execute(
+            f"""
+            DELETE FROM solutions WHERE key IN (
+                SELECT key FROM (
+                    SELECT
+                        key,
+                        row_number() OVER kept AS kept_rows,
+                        sum(size) OVER kept AS kept_bytes
+                    FROM solutions
+                    WINDOW kept AS (ORDER BY {order}, key)
+                )
+                WHERE kept_rows > ? OR kept_bytes > ?
+            )
+            """,
+            (
+                2**63 - 1 if max_rows is None else max_rows,
+                2**63 - 1 if max_bytes is None else max_bytes,
+            ),
+        ).rowcount
+    if ttl is not None:
+        con.execute("DELETE FROM levels WHERE created_at < ?", (time.time() - ttl,))
+    if max_rows is not None:
         con.execute(
-            "INSERT INTO water_filling VALUES (?,?,?,?)",
-            (heights_bytes, volume_bytes, as_dict["level"], as_dict["svg"]),
+            """
+            DELETE FROM levels WHERE key IN (
+                SELECT key FROM levels ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (max_rows,),
         )
-    return as_dict
+    con.execute("PRAGMA incremental_vacuum").fetchall()
+    return deleted
@@ -1,23 +1,59 @@
 """Microdot frontend."""
 
 import asyncio
+import contextlib
+import hashlib
+import json
+import signal
 from pathlib import Path
 from urllib.parse import quote
 
 import jinja2
 import mistune
-from microdot import Microdot, redirect
+import numpy as np
+from microdot import Microdot, Request, redirect
 from microdot.jinja import Template
 
-from water_filling import colors, database, numerics, serialization
+from water_filling import (
+    colors,
+    compression,
+    database,
+    numerics,
+    pages,
+    render,
+    serialization,
+    snapshot,
+)
+from water_filling.bench import Bench
 from water_filling.options import get_options
 
 options = get_options()
 
 
+class App(Microdot):
+    """Microdot app that accepts larger request bodies on some routes.
+
+    Those bodies may be larger than `Request.max_body_length`, so the routes in
+    `streamed_routes`, as `{path: max_content_length}`, must read them from
+    `request.stream`.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.streamed_routes = {}
+
+    async def dispatch_request(self, req):
+        if req and (max_length := self.streamed_routes.get(req.path)) is not None:
+            req.max_content_length = max_length
+        return await super().dispatch_request(req)
+
+
 def initialize_app():
     """Initialize `app` and populate Jinja template globals."""
-    app = Microdot()
+    app = App()
+    # Large terrains are sent in request bodies, up to 2**16 numbers as JSON
+    Request.max_body_length = 2**22
+    Request.max_content_length = 2**22
 
     Template.initialize(
         Path(__file__).parent / "templates",
@@ -35,25 +71,115 @@ def initialize_app():
     Template.jinja_env.globals["static"] = False
     Template.jinja_env.globals["prefix"] = options.prefix
 
+    # Changes whenever the pages or images could, to version ETags and the URL
+    # of the stylesheet
+    version = hashlib.blake2b(digest_size=8)
+    for template_path in sorted((Path(__file__).parent / "templates").iterdir()):
+        version.update(template_path.read_bytes())
+    version.update(header_markdown.encode())
+    version.update(
+        repr(
+            (colors.colors, options.renderer, options.max_columns, options.prefix)
+        ).encode()
+    )
+    Template.jinja_env.globals["version"] = version.hexdigest()
+
     return app
 
 
 app = initialize_app()
 
+# Solutions never change, so they can be cached for as long as clients like
+cache_control_immutable = "public, max-age=31536000, immutable"
 
-async def fulfill(request, response_dict):
+
+def representation(request):
+    """Negotiate the representation of a solution: "html", "svg" or "json"."""
     accept = request.headers.get("Accept", "").lower()
     if "text/html" in accept:
-        html = await Template("visualize.html").render_async(
-            **response_dict,
+        return "html"
+    if "image/svg" in accept:
+        return "svg"
+    # Default to JSON
+    return "json"
+
+
+def accepted_encodings(request):
+    """Content codings listed in `Accept-Encoding`, most preferred first."""
+    codings = []
+    for item in request.headers.get("Accept-Encoding", "").lower().split(","):
+        coding, *params = (part.strip() for part in item.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding and q > 0:
+            codings.append((q, coding))
+    return [coding for _, coding in sorted(codings, key=lambda x: -x[0])]
+
+
+def needs_svg(request):
+    """Whether the response to `request` will contain the SVG.
+
+    JSON clients get just the numbers unless they ask for `?include=svg`.
+    """
+    if representation(request) != "json":
+        return True
+    return "svg" in request.args.get("include", "").split(",")
+
+
+def variant(request):
+    """Like `representation()`, but `"json+svg"` for JSON with the SVG."""
+    if (res := representation(request)) == "json" and needs_svg(request):
+        return "json+svg"
+    return res
+
+
+def etag(request, key):
+    """Weak ETag for the response to `request` for the solution under `key`.
+
+    Weak because JSON and HTML responses say whether they came from the cache.
+    """
+    version = Template.jinja_env.globals["version"]
+    return f'W/"{key.hex()}-{variant(request)}-{version}"'
+
+
+def not_modified(request, tag):
+    """Whether `If-None-Match` in `request` matches the ETag `tag`."""
+    if (if_none_match := request.headers.get("If-None-Match")) is None:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or tag.removeprefix("W/") in tags
+
+
+async def render_page(response_dict):
+    """Render `visualize.html`, or stream it if the SVG is large.
+
+    Large pages are streamed as the part of the page before the SVG, the SVG,
+    and the part after, so that the whole page is never built in memory.
+    """
+    if len(response_dict["svg"]) < options.stream_svg_bytes:
+        return await Template("visualize.html").render_async(**response_dict)
+    head, tail = pages.split(
+        await Template("visualize.html").render_async(
+            **{**response_dict, "svg": pages.svg_sentinel}
         )
-        return html, {"Content-Type": "text/html"}
+    )
+    return pages.stream(head, response_dict["svg"], tail)
 
-    if "image/svg" in accept:
-        return response_dict["svg"], {"Content-Type": "image/svg"}
 
-    # Default to JSON
-    return serialization.filtered(response_dict)
+async def fulfill(request, response_dict):
+    match representation(request):
+        case "html":
+            return await render_page(response_dict), {"Content-Type": "text/html"}
+        case "svg":
+            return response_dict["svg"], {"Content-Type": "image/svg"}
+        case "json":
+            return serialization.filtered(response_dict, needs_svg(request)), {}
 
 
 @app.get(f"{options.prefix}/level")
@@ -63,8 +189,61 @@ async def get_level(request):
     if heights is None or volume is None:
         return "Bad request", 400
 
-    response_dict = database.fulfill_as_json_serializable_with_cache(heights, volume)
-    return await fulfill(request, response_dict)
+    # Permalinks always show the same solution, so clients and proxies may keep
+    # it, and check back by ETag without the solution being loaded
+    headers = {
+        "ETag": etag(request, database.digest(heights, volume)),
+        "Cache-Control": cache_control_immutable,
+        "Vary": "Accept, Accept-Encoding",
+    }
+    if not_modified(request, headers["ETag"]):
+        return "", 304, headers
+    body, response_headers = await respond(request, heights, volume)
+    return body, {**response_headers, **headers}
+
+
+# Pages rendered from cached solutions, by digest. Pages of solutions that were
+# just computed are not kept, as they say so, and neither are streamed ones.
+rendered_pages = pages.BodyCache(options.page_cache_bytes)
+
+
+async def respond(request, heights, volume):
+    """Respond to `request` with the solution for `heights` and `volume`."""
+    key = database.digest(heights, volume)
+    if (
+        representation(request) == "html"
+        and (page := rendered_pages.get(key)) is not None
+    ):
+        database.record_access(key)
+        return page, {"Content-Type": "text/html"}
+
+    if representation(request) == "svg":
+        # Send the compressed SVG straight from the cache if the client accepts
+        # the codec it was stored with
+        for coding in accepted_encodings(request):
+            if (codec := database.content_codings.get(coding)) and (
+                svg_encoded := await database.fetch_svg_encoded_async(key, codec)
+            ) is not None:
+                return svg_encoded, {
+                    "Content-Type": "image/svg",
+                    "Content-Encoding": coding,
+                }
+
+    response_dict = await database.fulfill_as_json_serializable_with_cache_async(
+        heights, volume, needs_svg(request)
+    )
+    body, headers = await fulfill(request, response_dict)
+    # Responses that say the solution was just computed must not be replayed
+    # from the caches of rendered or compressed bodies
+    request.g.computed = not response_dict["cached"]
+    if (
+        representation(request) == "html"
+        and not request.g.computed
+        and isinstance(body, str)
+    ):
+        body = body.encode()
+        rendered_pages.put(key, body)
+    return body, headers
 
 
 @app.get(f"{options.prefix}/")
@@ -87,6 +266,34 @@ async def get_index(request):
 
 @app.post(f"{options.prefix}/level")
 async def post_level(request):
+    """Solve for heights sent in the body, or redirect a form submission.
+
+    The heights may be sent as a JSON array, as raw little-endian numbers
+    (`application/octet-stream`, with `?dtype=float64` or `?dtype=int64`), or as
+    the contents of a `.npy` file (`application/x-npy`). The volume is given in
+    the query string.
+    """
+    match (request.content_type or "").split(";")[0].strip().lower():
+        case "application/json":
+            heights = serialization.parse_heights_json(request.body)
+        case "application/octet-stream":
+            heights = serialization.parse_heights_binary(
+                request.body, request.args.get("dtype", "float64")
+            )
+        case "application/x-npy":
+            heights = serialization.parse_heights_npy(request.body)
+        case _:
+            return post_form(request)
+
+    volume = serialization.parse_volume(request.args.get("volume"))
+    if heights is None or volume is None:
+        return "Bad request", 400
+    return await respond(request, heights, volume)
+
+
+def post_form(request):
+    if request.form is None:
+        return "Bad request", 400
     heights_str = request.form.get("heights")
     volume_str = request.form.get("volume")
 
@@ -104,51 +311,319 @@ async def post_level(request):
     return redirect(serialization.to_path(heights_str, volume_str))
 
 
-bench = []
+# Limits on the problems solved at once by `POST /levels`: the number of rows,
+# and the number of elements of the padded heights passed to `level_batch()`
+batch_max_rows = 1024
+batch_max_elements = 2**20
+# NDJSON batches are read as they are solved, so they can be much larger than
+# other request bodies
+batch_max_content_length = 2**32
+
+
+@app.post(f"{options.prefix}/levels")
+async def post_levels(request):
+    """Solve a batch of problems, streaming the solutions as NDJSON.
+
+    The problems look like `{"heights": [1, 2, 3], "volume": 2}`, and are sent
+    as a JSON array or as NDJSON (one problem per line). Only NDJSON bodies may
+    be larger than `Request.max_body_length`, up to `batch_max_content_length`.
+    Each solution is a line `{"level": 1.5}` in the order of the problems, with
+    the SVG added if `?include=svg` is given, or a line
+    `{"error": "Invalid problem"}`.
+    """
+    match (request.content_type or "").split(";")[0].strip().lower():
+        case "application/json":
+            if request.content_length > Request.max_body_length:
+                return "Payload too large, send NDJSON instead", 413
+            try:
+                problems = json.loads(request.body)
+            except (ValueError, RecursionError):
+                return "Bad request", 400
+            if not isinstance(problems, list):
+                return "Bad request", 400
+            problems = aiter_list(problems)
+        case "application/x-ndjson" | "application/ndjson" | "application/jsonl":
+            problems = read_ndjson(request)
+        case _:
+            return "Bad request", 400
+
+    include_svg = "svg" in request.args.get("include", "").split(",")
+    return stream_levels(problems, include_svg), {
+        "Content-Type": "application/x-ndjson"
+    }
 
 
-async def replenish_bench():
-    while True:
-        if (shortfall := 10 - len(bench)) > 0:
-            print(f"Replenishing bench: {shortfall = }")
-
-        for _ in range(shortfall):
-            heights, volume = numerics.random()
-            # No sense caching random instances that may never even be accessed
-            response_dict = database.fulfill_as_json_serializable_skip_cache(
-                heights, volume
+app.streamed_routes[f"{options.prefix}/levels"] = batch_max_content_length
+
+
+async def aiter_list(items):
+    for item in items:
+        yield item
+
+
+async def read_ndjson(request):
+    """Yield the values on the lines of the body, or `None` for invalid ones.
+
+    The body is read in pieces, so it need not fit in memory. Lines longer than
+    `Request.max_body_length` are invalid, and dropped as they are read.
+    """
+    remaining = request.content_length
+    # The start of the line being read, unless it is too long and was dropped
+    buffer = bytearray()
+    too_long = False
+    while remaining > 0 and (data := await request.stream.read(min(remaining, 2**16))):
+        remaining -= len(data)
+        if (cut := data.rfind(b"\n")) == -1:
+            head, lines = data, None
+        else:
+            head, *lines = data[:cut].split(b"\n")
+        if not too_long:
+            buffer += head
+            too_long = len(buffer) > Request.max_body_length
+        if lines is None:
+            if too_long:
+                buffer.clear()
+            continue
+
+        for i, line in enumerate([buffer, *lines]):
+            if (too_long and i == 0) or len(line) > Request.max_body_length:
+                yield None
+            elif line.strip():
+                yield parse_json_line(line)
+        buffer = bytearray(data[cut + 1 :])
+        too_long = False
+    if too_long or len(buffer) > Request.max_body_length:
+        yield None
+    elif buffer.strip():
+        yield parse_json_line(buffer)
+
+
+def parse_json_line(line):
+    try:
+        return json.loads(line)
+    except (ValueError, RecursionError):
+        # Deeply nested values exhaust the decoder's recursion limit
+        return None
+
+
+async def stream_levels(problems, include_svg=False):
+    """Solve `problems` chunk by chunk, yielding NDJSON lines for each chunk."""
+    chunk = []
+    width = 0
+    async for problem in problems:
+        problem = serialization.parse_problem(problem)
+        if problem is not None:
+            size = problem[0].size
+            if len(chunk) >= batch_max_rows or (
+                (len(chunk) + 1) * max(width, size) > batch_max_elements
+            ):
+                yield await solve_chunk(chunk, include_svg)
+                chunk = []
+                width = 0
+            width = max(width, size)
+        chunk.append(problem)
+    if chunk:
+        yield await solve_chunk(chunk, include_svg)
+
+
+async def solve_chunk(chunk, include_svg):
+    """NDJSON lines with the solutions of the problems in `chunk`.
+
+    Invalid problems are `None` in `chunk`.
+    """
+    problems = [problem for problem in chunk if problem is not None]
+    levels = np.empty(0)
+    if problems:
+        heights, sizes = numerics.list_to_padded([h for h, _ in problems])
+        volumes = [v for _, v in problems]
+        levels = await asyncio.to_thread(numerics.level_batch, heights, volumes, sizes)
+    solutions = [{"level": level} for level in levels.tolist()]
+    if include_svg:
+        svgs = await asyncio.gather(
+            *(
+                render.render_svg_async(h, level)
+                for (h, _), level in zip(problems, levels, strict=True)
             )
-            bench.append(response_dict)
+        )
+        for solution, svg_data in zip(solutions, svgs, strict=True):
+            solution["svg"] = svg_data
+
+    solutions = iter(solutions)
+    lines = []
+    for problem in chunk:
+        if problem is None:
+            lines.append('{"error": "Invalid problem"}\n')
+        else:
+            lines.append(json.dumps(next(solutions)) + "\n")
+    return "".join(lines).encode()
+
 
-        await asyncio.sleep(5)
+content_types = {
+    "html": "text/html",
+    "svg": "image/svg",
+    "json": "application/json",
+    "json+svg": "application/json",
+}
+
+
+async def make_bench_entry():
+    """Solve a random instance, and build the response body for each variant."""
+    heights, volume = numerics.random()
+    # No sense caching random instances that may never even be accessed
+    response_dict = await database.fulfill_as_json_serializable_skip_cache_async(
+        heights, volume
+    )
+    response_dict["bench"] = True
+    return {
+        "html": await Template("visualize.html").render_async(**response_dict),
+        "svg": response_dict["svg"],
+        "json": json.dumps(serialization.filtered(response_dict)),
+        "json+svg": json.dumps(serialization.filtered(response_dict, True)),
+    }
+
+
+bench = Bench(
+    make_bench_entry,
+    min_size=options.bench_min_size,
+    max_size=options.bench_max_size,
+    concurrency=max(options.render_workers, 1),
+)
+
+
+async def evict_periodically():
+    while True:
+        await asyncio.sleep(options.cache_evict_interval)
+        if deleted := await database.evict_async(
+            max_rows=options.cache_max_rows,
+            max_bytes=options.cache_max_bytes,
+            ttl=options.cache_ttl,
+            policy=options.cache_policy,
+        ):
+            print(f"Evicted from cache: {deleted = }")
 
 
 @app.get(f"{options.prefix}/random")
 async def get_random(request):
-    if bench:
-        response_dict = bench.pop()
-        response_dict["bench"] = True
-    else:
-        heights, volume = numerics.random()
-        # Skip cache for consistency with bench case; only upon clicking
-        # permalink will cache be saved
-        response_dict = database.fulfill_as_json_serializable_skip_cache(
-            heights, volume
-        )
+    if (entry := bench.pop()) is not None:
+        key = variant(request)
+        return entry[key], {"Content-Type": content_types[key]}
+
+    heights, volume = numerics.random()
+    # Skip cache for consistency with bench case; only upon clicking
+    # permalink will cache be saved
+    response_dict = await database.fulfill_as_json_serializable_skip_cache_async(
+        heights, volume, needs_svg(request)
+    )
     return await fulfill(request, response_dict)
 
 
+@app.get(f"{options.prefix}/stats")
+async def get_stats(request):
+    return {"cache": database.stats(), "bench": bench.report()}
+
+
 @app.get(f"{options.prefix}/style.css")
 async def get_style(request):
-    css = await Template("style.css").render_async()
-    return css, {
+    version = Template.jinja_env.globals["version"]
+    headers = {
         "Content-Type": "text/css",
-        "Max-Age": 3600 * 24,
+        "ETag": f'W/"style-{version}"',
+        # Pages link to the stylesheet with the version in the URL
+        "Cache-Control": cache_control_immutable
+        if request.args.get("v") == version
+        else "public, max-age=86400",
     }
+    if not_modified(request, headers["ETag"]):
+        return "", 304, headers
+    return await render_style(), headers
+
+
+style_css = None
+
+
+async def render_style():
+    """Render `style.css`, which only depends on globals, the first time only."""
+    global style_css
+    if style_css is None:
+        style_css = await Template("style.css").render_async()
+    return style_css
+
+
+compressed_bodies = pages.BodyCache(options.compress_cache_bytes)
+
+
+@app.after_request
+async def compress_response(request, response):
+    """Compress the body of `response` if the client accepts it."""
+    for coding in accepted_encodings(request):
+        if coding in compression.encoders:
+            break
+    else:
+        return response
+    if not compression.compressible(response, options.compress_min_bytes):
+        return response
+
+    if compression.streamed(response):
+        response.body = compression.compress_stream(response.body, coding)
+    else:
+        response.body = await compress_body(request, response, coding)
+    response.headers["Content-Encoding"] = coding
+    response.headers.pop("Content-Length", None)
+    vary = response.headers.get("Vary")
+    if vary is None:
+        response.headers["Vary"] = "Accept-Encoding"
+    elif "accept-encoding" not in vary.lower():
+        response.headers["Vary"] = f"{vary}, Accept-Encoding"
+    return response
+
+
+async def compress_body(request, response, coding):
+    """The body of `response` to `request`, compressed with `coding`."""
+    # Responses with an ETag are the same next time, so keep their compressed
+    # bodies; weak ETags are fine, as any equivalent body will do, as long as
+    # it does not say that the solution was just computed
+    key = None
+    if (tag := response.headers.get("ETag")) and not getattr(
+        request.g, "computed", False
+    ):
+        key = (tag, coding)
+    if key is None or (body := compressed_bodies.get(key)) is None:
+        encode = compression.encoders[coding]
+        if len(response.body) < 2**16:
+            body = encode(response.body)
+        else:
+            body = await asyncio.to_thread(encode, response.body)
+        if key is not None:
+            compressed_bodies.put(key, body)
+    return body
+
+
+async def snapshot_periodically():
+    while True:
+        await asyncio.sleep(options.snapshot_interval)
+        state = snapshot.state(bench, Template.jinja_env.globals["version"])
+        await asyncio.to_thread(snapshot.save, state)
 
 
 async def main():
+    # Deploys stop the server with SIGTERM, which is made to unwind like Ctrl-C
+    # so that the cache and the snapshot are written out below
+    with contextlib.suppress(NotImplementedError):  # Not on Windows
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGTERM, asyncio.current_task().cancel
+        )
+    await render_style()
+    if snapshot.load(bench, Template.jinja_env.globals["version"], content_types):
+        print(
+            f"Loaded snapshot: {len(bench)} bench entries, {len(database.memory)} solutions"
+        )
     server = asyncio.create_task(app.start_server())
-    replenisher = asyncio.create_task(replenish_bench())
+    replenisher = asyncio.create_task(bench.run())
+    evicter = asyncio.create_task(evict_periodically())
+    snapshotter = asyncio.create_task(snapshot_periodically())
     print("Serving app on http://localhost:5000")
-    await asyncio.gather(server, replenisher)
+    try:
+        await asyncio.gather(server, replenisher, evicter, snapshotter)
+    finally:
+        snapshot.save(snapshot.state(bench, Template.jinja_env.globals["version"]))
+        database.close()
@@ -0,0 +1,40 @@
+"""Level-of-detail reduction of large terrains for drawing."""
+
+import numpy as np
+
+
+def envelope(heights, max_columns):
+    """Columns to draw for `heights`, at most `max_columns` of them.
+
+    Returns `(edges, tops)`, where column `j` spans `edges[j]` to `edges[j + 1]`
+    on the horizontal axis (in which height `i` is centered at `i`) and has
+    height `tops[j]`. If there are more heights than `max_columns`, consecutive
+    heights are grouped into buckets, and each bucket is drawn as two columns
+    with its minimum and maximum, so that peaks and troughs stay visible, which
+    takes a `max_columns` of at least 2.
+    """
+    heights = np.asanyarray(heights)
+    n = heights.size
+    if n <= max_columns:
+        return np.arange(n + 1) - 0.5, heights
+    if max_columns < 2:
+        raise ValueError("max_columns must be at least 2")
+
+    buckets = max_columns // 2
+    bounds = np.linspace(0, n, buckets + 1).astype(np.intp)
+    starts, stops = bounds[:-1], bounds[1:]
+    mins = np.minimum.reduceat(heights, starts)
+    maxs = np.maximum.reduceat(heights, starts)
+
+    # Draw rising buckets min-then-max and falling buckets max-then-min
+    rising = heights[starts] <= heights[stops - 1]
+    tops = np.where(
+        rising[:, np.newaxis],
+        np.stack([mins, maxs], axis=1),
+        np.stack([maxs, mins], axis=1),
+    ).ravel()
+
+    edges = np.empty(2 * buckets + 1)
+    edges[0::2] = bounds - 0.5
+    edges[1::2] = (starts + stops) / 2 - 0.5
+    return edges, tops
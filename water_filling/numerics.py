@@ -1,11 +1,24 @@
 """NumPy implementation of linear interpolation method for water-filling."""
 
+import functools
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
 rng = np.random.default_rng()
 
+# Terrains at least this large are solved by selection rather than sorting
+# when `level()` is called with `strategy="auto"`
+select_threshold = 2**20
+
+# Terrains smaller than this are processed serially even if `workers` is given
+parallel_threshold = 2**22
 
-def volume(heights, level):
+
+def volume(heights, level, workers=None):
     """Volume of water above terrain with given heights.
 
     For example, `heights = [1, 4, 2, 3]` can be visualized as:
@@ -20,19 +33,51 @@ def volume(heights, level):
     When `level = 2.5`, there is a volume of `1.5` units of water above the
     terrain at index `0`, and `0.5` units of water at index `2`, for a total
     volume of `2.0`.
+
+    If `workers` is given and there are at least `parallel_threshold` heights,
+    the sum is split across that many threads.
     """
     heights = np.asanyarray(heights)
+    if workers and heights.size >= parallel_threshold:
+        chunks = np.array_split(heights.ravel(), 4 * workers)
+        partial_volumes = _executor(workers).map(
+            functools.partial(volume, level=level), chunks
+        )
+        return sum(partial_volumes, start=np.float64(0.0))
     return np.clip(level - heights, 0, None).sum()
 
 
-def level(heights, target_volume):
+def level(heights, target_volume, strategy="auto", workers=None):
     """Determine `level` such that `volume(heights, level) = target_volume.`
 
-    Use linear interpolation.
+    With `strategy="sort"`, use linear interpolation on the sorted heights. With
+    `strategy="select"`, use `level_select()`, which takes expected linear time.
+    The default `strategy="auto"` picks the latter for terrains of at least
+    `select_threshold` heights.
+
+    If `workers` is given and there are at least `parallel_threshold` heights,
+    `strategy` is ignored and the level is found by `level_streaming()` with
+    the chunks spread across that many threads.
     """
     if not target_volume >= 0.0:
         raise ValueError(volume)
 
+    if workers and np.size(heights) >= parallel_threshold:
+        heights = np.asanyarray(heights).ravel()
+        return level_streaming(
+            heights,
+            target_volume,
+            chunk_size=-(-heights.size // (4 * workers)),
+            workers=workers,
+        )
+
+    if strategy == "auto":
+        strategy = "select" if np.size(heights) >= select_threshold else "sort"
+    if strategy == "select":
+        return level_select(heights, target_volume)
+    if strategy != "sort":
+        raise ValueError(strategy)
+
     # Since volume(heights, level) is piecewise linear monotonic in the level,
     # so is its inverse, hence it suffices to construct a vector of `volumes`
     # corresponding to the volume when the level matches each values in
@@ -56,6 +101,531 @@ def level(heights, target_volume):
     return np.interp(target_volume, volumes, heights)
 
 
+def level_select(heights, target_volume):
+    """Solve for the level in expected O(n) time without sorting the heights.
+
+    Quickselect on the breakpoints: partition the candidate heights about their
+    median, evaluate the volume at the median using running sums of the heights
+    already known to be submerged, and keep the half that contains the level.
+    Only one float64 copy of `heights` is made; the partitions are in place.
+    """
+    if not target_volume >= 0.0:
+        raise ValueError(target_volume)
+    work = np.array(heights, dtype=np.float64).ravel()
+    if not work.size:
+        raise ValueError("Empty heights")
+    return _level_select(work, target_volume)
+
+
+def _level_select(work, target_volume, count=0, total=0.0):
+    """Selection loop of `level_select()`, reordering `work` in place.
+
+    `count` and `total` are the number and sum of heights outside of `work`
+    already known to lie below the level.
+    """
+    while work.size:
+        k = work.size // 2
+        work.partition(k)
+        pivot = work[k]
+        below = work[:k].sum()
+        # Heights equal to the pivot contribute nothing, so `work[:k]` suffices
+        if (count + k) * pivot - (total + below) <= target_volume:
+            count += k + 1
+            total += below + pivot
+            work = work[k + 1 :]
+        else:
+            work = work[:k]
+
+    # Every submerged height is now accounted for, so volume is linear in level
+    return np.float64((target_volume + total) / count)
+
+
+def level_streaming(
+    heights,
+    target_volume,
+    chunk_size=2**20,
+    bins=1024,
+    max_buffer=2**16,
+    workers=None,
+):
+    """Solve for the level in a bounded number of passes over chunked heights.
+
+    `heights` is either an array-like such as an `np.memmap`, which is read in
+    slices of `chunk_size` elements, or a callable that returns a fresh iterable
+    of 1-D chunks on each call (a one-shot iterator will not do, because several
+    passes are needed). Peak memory is proportional to `chunk_size`, `bins` and
+    `max_buffer`, and independent of the size of the terrain.
+
+    The first pass finds the extremes of the heights. Each later pass refines
+    the bracket `[lo, hi)` containing the level to one of `bins` subintervals
+    using a histogram of the heights inside it. As soon as at most `max_buffer`
+    heights remain inside, they are collected and solved exactly in memory.
+
+    If `workers` is given, the chunks of each pass are summarized on that many
+    threads (NumPy releases the GIL while doing so) and the partial counts,
+    sums and histograms are combined as they come. Only a few chunks per worker
+    are read ahead, so peak memory stays independent of the size of the terrain.
+    """
+    if not target_volume >= 0.0:
+        raise ValueError(target_volume)
+
+    if workers:
+        map_chunks = functools.partial(_map_ahead, workers=workers)
+    else:
+        map_chunks = map
+
+    count, total, lo, hi = 0, 0.0, np.inf, -np.inf
+    for chunk_count, chunk_total, chunk_lo, chunk_hi in map_chunks(
+        _extremes, _iter_chunks(heights, chunk_size)
+    ):
+        count += chunk_count
+        total += chunk_total
+        lo = min(lo, chunk_lo)
+        hi = max(hi, chunk_hi)
+    if not count:
+        raise ValueError("Empty heights")
+    if (level := (target_volume + total) / count) >= hi:
+        # Everything is submerged
+        return np.float64(level)
+
+    # Invariant: volume(lo) <= target_volume < volume(hi)
+    while True:
+        edges = np.linspace(lo, hi, bins + 1)
+        count, total = 0, 0.0
+        counts, sums = np.zeros(bins, dtype=np.int64), np.zeros(bins)
+        buffer, buffered = [], 0
+        for below_count, below_total, chunk_counts, chunk_sums, inside in map_chunks(
+            functools.partial(_bracket_stats, edges=edges, max_buffer=max_buffer),
+            _iter_chunks(heights, chunk_size),
+        ):
+            count += below_count
+            total += below_total
+            counts += chunk_counts
+            sums += chunk_sums
+            if buffer is not None:
+                if inside is None or (buffered := buffered + inside.size) > max_buffer:
+                    buffer = None
+                else:
+                    buffer.append(inside)
+
+        if buffer is not None:
+            # Few enough heights left between lo and hi to finish in memory
+            work = np.concatenate([np.empty(0), *buffer])
+            return _level_select(work, target_volume, count, total)
+
+        cum_counts = count + np.concatenate([[0], counts.cumsum()])
+        cum_sums = total + np.concatenate([[0.0], sums.cumsum()])
+        volumes = cum_counts * edges - cum_sums
+        j = min(np.searchsorted(volumes, target_volume, side="right") - 1, bins - 1)
+        lo, hi = edges[j], edges[j + 1]
+
+
+def volume_streaming(heights, level, chunk_size=2**20):
+    """Chunked `volume()`, taking `heights` as in `level_streaming()`."""
+    return sum(
+        (volume(chunk, level) for chunk in _iter_chunks(heights, chunk_size)),
+        start=np.float64(0.0),
+    )
+
+
+def _iter_chunks(heights, chunk_size):
+    if callable(heights):
+        for chunk in heights():
+            yield np.asarray(chunk, dtype=np.float64).ravel()
+    else:
+        for start in range(0, len(heights), chunk_size):
+            chunk = heights[start : start + chunk_size]
+            yield np.asarray(chunk, dtype=np.float64).ravel()
+
+
+def _extremes(chunk):
+    if not chunk.size:
+        return 0, 0.0, np.inf, -np.inf
+    return chunk.size, chunk.sum(), chunk.min(), chunk.max()
+
+
+def _bracket_stats(chunk, edges, max_buffer):
+    """Summarize the heights in `chunk` relative to the bracket `edges`.
+
+    Returns the count and sum of the heights at or below `edges[0]`, per-bin
+    histograms of the count and sum of the heights strictly inside the bracket,
+    and the inside heights themselves if there are at most `max_buffer`.
+    """
+    lo, hi = edges[0], edges[-1]
+    below = chunk[chunk <= lo]
+    inside = chunk[(lo < chunk) & (chunk < hi)]
+    # Equivalent to `np.histogram()` with uniform bins, sharing the bin indices
+    bins = edges.size - 1
+    i = ((inside - lo) * (bins / (hi - lo))).astype(np.intp)
+    np.clip(i, 0, bins - 1, out=i)
+    # Correct for rounding so that bins agree exactly with `edges`
+    i -= inside < edges[i]
+    i += (inside >= edges[i + 1]) & (i < bins - 1)
+    counts = np.bincount(i, minlength=bins)
+    sums = np.bincount(i, weights=inside, minlength=bins)
+    return (
+        below.size,
+        below.sum(),
+        counts,
+        sums,
+        inside if inside.size <= max_buffer else None,
+    )
+
+
+@functools.cache
+def _executor(workers):
+    """Thread pool shared by all parallel computations with this many workers."""
+    return ThreadPoolExecutor(workers, thread_name_prefix="numerics")
+
+
+def _map_ahead(func, iterable, workers):
+    """Like `map()`, but calling `func` on `_executor(workers)`.
+
+    Unlike `Executor.map()`, which submits every call up front, this reads at
+    most `2 * workers` items of `iterable` ahead of the results consumed.
+    """
+    executor = _executor(workers)
+    futures = deque()
+    for item in iterable:
+        if len(futures) >= 2 * workers:
+            yield futures.popleft().result()
+        futures.append(executor.submit(func, item))
+    while futures:
+        yield futures.popleft().result()
+
+
+def breakpoints(heights):
+    """Sorted `heights` and the volume when the level matches each of them.
+
+    Returns a pair of float64 arrays `(heights, volumes)` of the same size, with
+    `heights` sorted in ascending order and `volumes[i] == volume(heights,
+    heights[i])`. These are the breakpoints of the piecewise linear function
+    `volume(heights, level)`; past `heights[-1]`, its slope is `heights.size`.
+    """
+    heights = np.sort(np.asanyarray(heights, dtype=np.float64), axis=None)
+    if not heights.size:
+        raise ValueError("Empty heights")
+    diff = np.diff(heights, prepend=heights[:1])
+    volumes = (diff * np.arange(heights.size)).cumsum()
+    return heights, volumes
+
+
+def level_many(heights, target_volumes):
+    """Vectorized `level()` for a whole array of volumes on the same terrain.
+
+    The terrain is sorted once, so answering `k` volumes takes O(n log n + k log
+    n) time instead of O(k n log n) for calling `level()` in a loop. Returns an
+    array of float64 levels with the same shape as `target_volumes`.
+    """
+    return Terrain(heights).level(target_volumes)
+
+
+class Terrain:
+    """Terrain with precomputed breakpoints of its volume function.
+
+    Construction takes O(n log n) time, after which `level()` and `volume()`
+    take O(log n) time per query. Both accept scalars or arrays.
+    """
+
+    def __init__(self, heights):
+        self.heights, self.volumes = breakpoints(heights)
+
+    @property
+    def nbytes(self):
+        return self.heights.nbytes + self.volumes.nbytes
+
+    def level(self, target_volumes):
+        """Level at which the volume of water is `target_volumes`."""
+        target_volumes = np.asanyarray(target_volumes, dtype=np.float64)
+        if not (target_volumes >= 0.0).all():
+            raise ValueError(target_volumes)
+
+        # Between heights[i] and heights[i+1] (or past the end of the array),
+        # the volume grows with slope i + 1, so there is no need for a dummy
+        # height.
+        i = np.searchsorted(self.volumes, target_volumes, side="right") - 1
+        return self.heights[i] + (target_volumes - self.volumes[i]) / (i + 1)
+
+    def volume(self, levels):
+        """Volume of water when the level is `levels`."""
+        levels = np.asanyarray(levels, dtype=np.float64)
+        # Number of heights submerged, at least one to keep indices valid
+        k = np.maximum(np.searchsorted(self.heights, levels, side="right"), 1)
+        res = self.volumes[k - 1] + k * (levels - self.heights[k - 1])
+        return np.maximum(res, 0.0)
+
+
+class TerrainRegistry:
+    """Thread-safe LRU cache of `Terrain` objects, bounded by memory use.
+
+    Terrains are keyed by a digest of the dtype and contents of their heights,
+    and the least recently used ones are dropped once the combined `nbytes` of
+    the cached terrains exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._terrains = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._terrains)
+
+    @staticmethod
+    def key(heights):
+        heights = np.ascontiguousarray(heights)
+        digest = hashlib.blake2b(heights.dtype.str.encode(), digest_size=16)
+        digest.update(heights.data)
+        return digest.digest()
+
+    def get(self, heights):
+        """Fetch the `Terrain` for `heights`, building it if necessary."""
+        key = self.key(heights)
+        with self._lock:
+            if (terrain := self._terrains.get(key)) is not None:
+                self._terrains.move_to_end(key)
+                return terrain
+
+        terrain = Terrain(heights)
+        with self._lock:
+            if key not in self._terrains:
+                self._terrains[key] = terrain
+                self.nbytes += terrain.nbytes
+            while self.nbytes > self.max_bytes and len(self._terrains) > 1:
+                _, evicted = self._terrains.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return terrain
+
+
+terrains = TerrainRegistry(max_bytes=2**27)
+
+
+class DynamicTerrain:
+    """Terrain that supports changing individual heights.
+
+    The heights are kept in a treap (a randomized balanced binary search tree)
+    whose nodes carry the count and sum of the heights in their subtree. This
+    allows `update()`, `level()` and `volume()` in expected O(log n) time, after
+    O(n log n) construction.
+    """
+
+    def __init__(self, heights):
+        self.heights = np.array(heights, dtype=np.float64).ravel()
+        if not self.heights.size:
+            raise ValueError("Empty heights")
+        keys = np.sort(self.heights).tolist()
+        priorities = rng.random(len(keys)).tolist()
+        self._root = _treap_from_sorted(keys, priorities)
+
+    def __len__(self):
+        return self.heights.size
+
+    def update(self, index, new_height):
+        """Set `self.heights[index] = new_height`."""
+        new_height = float(new_height)
+        if not np.isfinite(new_height):
+            raise ValueError(new_height)
+        old_height = float(self.heights[index])
+        self.heights[index] = new_height
+
+        # Remove one node with the old height, then insert the new one
+        lo, hi = _treap_split(self._root, old_height)
+        _, hi = _treap_pop_min(hi)
+        lo, mid = _treap_split(_treap_merge(lo, hi), new_height)
+        node = _TreapNode(new_height, rng.random())
+        self._root = _treap_merge(_treap_merge(lo, node), mid)
+
+    def level(self, target_volume):
+        """Level at which the volume of water is `target_volume`."""
+        if not target_volume >= 0.0:
+            raise ValueError(target_volume)
+
+        # Same descent as in `_level_select()`, with the treap in the role of
+        # the partitions
+        count, total = 0, 0.0
+        node = self._root
+        while node is not None:
+            left_count, left_total = _treap_stats(node.left)
+            if (count + left_count) * node.key - (total + left_total) <= target_volume:
+                count += left_count + 1
+                total += left_total + node.key
+                node = node.right
+            else:
+                node = node.left
+        return np.float64((target_volume + total) / count)
+
+    def volume(self, level):
+        """Volume of water when the level is `level`."""
+        count, total = 0, 0.0
+        node = self._root
+        while node is not None:
+            if node.key < level:
+                left_count, left_total = _treap_stats(node.left)
+                count += left_count + 1
+                total += left_total + node.key
+                node = node.right
+            else:
+                node = node.left
+        return np.float64(count * level - total)
+
+
+class _TreapNode:
+    __slots__ = ("count", "key", "left", "priority", "right", "total")
+
+    def __init__(self, key, priority):
+        self.key = key
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.count = 1
+        self.total = key
+
+    def refresh(self):
+        left_count, left_total = _treap_stats(self.left)
+        right_count, right_total = _treap_stats(self.right)
+        self.count = left_count + 1 + right_count
+        self.total = left_total + self.key + right_total
+
+
+def _treap_stats(node):
+    if node is None:
+        return 0, 0.0
+    return node.count, node.total
+
+
+def _treap_from_sorted(keys, priorities):
+    """Build a treap from sorted keys in linear time (Cartesian tree)."""
+    stack = []
+    for key, priority in zip(keys, priorities):
+        node = _TreapNode(key, priority)
+        last = None
+        while stack and stack[-1].priority < priority:
+            last = stack.pop()
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+
+    root = stack[0]
+    # Post-order traversal to fill in the subtree aggregates
+    pending, visited = [root], []
+    while pending:
+        node = pending.pop()
+        visited.append(node)
+        pending.extend(child for child in (node.left, node.right) if child)
+    for node in reversed(visited):
+        node.refresh()
+    return root
+
+
+def _treap_split(node, key):
+    """Split into treaps with keys `< key` and `>= key`."""
+    if node is None:
+        return None, None
+    if node.key < key:
+        node.right, hi = _treap_split(node.right, key)
+        node.refresh()
+        return node, hi
+    lo, node.left = _treap_split(node.left, key)
+    node.refresh()
+    return lo, node
+
+
+def _treap_merge(lo, hi):
+    """Merge treaps, assuming all keys in `lo` are at most those in `hi`."""
+    if lo is None:
+        return hi
+    if hi is None:
+        return lo
+    if lo.priority > hi.priority:
+        lo.right = _treap_merge(lo.right, hi)
+        lo.refresh()
+        return lo
+    hi.left = _treap_merge(lo, hi.left)
+    hi.refresh()
+    return hi
+
+
+def _treap_pop_min(node):
+    """Remove the smallest key, returning `(removed_node, new_root)`."""
+    if node.left is None:
+        return node, node.right
+    removed, node.left = _treap_pop_min(node.left)
+    node.refresh()
+    return removed, node
+
+
+def level_batch(heights, target_volumes, sizes=None):
+    """Solve many independent problem instances at once.
+
+    `heights` is a 2-D array whose row `r` holds the terrain of instance `r` in
+    its first `sizes[r]` entries (the rest is padding and is ignored), and
+    `target_volumes[r]` is the volume for that instance. If `sizes` is omitted,
+    every row is used in full. Returns a 1-D float64 array of levels.
+
+    Use `csr_to_padded()` or `list_to_padded()` to build the inputs.
+    """
+    heights = np.array(heights, dtype=np.float64, ndmin=2)
+    m, n = heights.shape
+    target_volumes = np.broadcast_to(
+        np.asanyarray(target_volumes, dtype=np.float64), (m,)
+    )
+    if not (target_volumes >= 0.0).all():
+        raise ValueError(target_volumes)
+    if sizes is None:
+        sizes = np.full(m, n)
+    else:
+        sizes = np.asanyarray(sizes)
+        if not ((0 < sizes) & (sizes <= n)).all():
+            raise ValueError(sizes)
+
+    # Push the padding to the end of each row, then overwrite it with the
+    # row's highest height so that it adds zero-width breakpoints only.
+    padding = np.arange(n) >= sizes[:, np.newaxis]
+    heights[padding] = np.inf
+    heights.sort(axis=1)
+    rows = np.arange(m)
+    highest = heights[rows, sizes - 1]
+    heights = np.where(padding, highest[:, np.newaxis], heights)
+
+    # Same construction as in `breakpoints()`, row by row
+    diff = np.diff(heights, axis=1, prepend=heights[:, :1])
+    volumes = (diff * np.arange(n)).cumsum(axis=1)
+
+    i = (volumes <= target_volumes[:, np.newaxis]).sum(axis=1) - 1
+    i = np.minimum(i, sizes - 1)
+    return heights[rows, i] + (target_volumes - volumes[rows, i]) / (i + 1)
+
+
+def csr_to_padded(values, offsets):
+    """Convert instances stored back to back into the input of `level_batch()`.
+
+    Instance `r` is `values[offsets[r]:offsets[r + 1]]`. Returns `(heights,
+    sizes)`.
+    """
+    values = np.asanyarray(values)
+    offsets = np.asanyarray(offsets)
+    sizes = np.diff(offsets)
+    m = sizes.size
+    heights = np.zeros((m, sizes.max(initial=0)), dtype=values.dtype)
+    values = values[offsets[0] : offsets[-1]]
+    rows = np.repeat(np.arange(m), sizes)
+    cols = np.arange(values.size) - np.repeat(offsets[:-1] - offsets[0], sizes)
+    heights[rows, cols] = values
+    return heights, sizes
+
+
+def list_to_padded(instances):
+    """Convert a sequence of 1-D height arrays into the input of `level_batch()`.
+
+    Returns `(heights, sizes)`.
+    """
+    instances = [np.asanyarray(h).ravel() for h in instances]
+    offsets = np.cumsum([0] + [h.size for h in instances])
+    return csr_to_padded(np.concatenate(instances), offsets)
+
+
 def random():
     """Random problem instance `(heights, volume)`."""
     n = rng.integers(10, 21)
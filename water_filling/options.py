@@ -15,7 +15,136 @@ def get_options():
         help='Prefix if site is to be hosted on a subdirectory. For example, if prefix="/prefix", then the /random endpoint is available at /prefix/random instead',
     )
 
+    parser.add_argument(
+        "--render-workers",
+        type=int,
+        default=2,
+        help="Number of worker processes that render SVG images off the event loop. If 0, render on the event loop",
+    )
+
+    parser.add_argument(
+        "--renderer",
+        choices=["matplotlib", "native"],
+        default="matplotlib",
+        help="Backend for SVG images. The native renderer writes SVG directly and is much faster, especially for large terrains",
+    )
+
+    parser.add_argument(
+        "--max-columns",
+        type=int,
+        default=1024,
+        help="Maximum number of terrain columns drawn in an SVG image, at least 2. Larger terrains are drawn as a min/max envelope, which bounds the image size",
+    )
+
+    parser.add_argument(
+        "--cache-max-rows",
+        type=int,
+        default=100_000,
+        help="Maximum number of solutions kept in the disk cache",
+    )
+
+    parser.add_argument(
+        "--cache-max-bytes",
+        type=int,
+        default=2**30,
+        help="Maximum total size in bytes of the solutions kept in the disk cache",
+    )
+
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=30 * 24 * 3600,
+        help="Seconds after which a solution is deleted from the disk cache",
+    )
+
+    parser.add_argument(
+        "--cache-policy",
+        choices=["lru", "lfu"],
+        default="lru",
+        help="Which solutions to delete first when the disk cache is too large: least recently used (lru) or least frequently used (lfu)",
+    )
+
+    parser.add_argument(
+        "--cache-evict-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between enforcements of the disk cache limits",
+    )
+
+    parser.add_argument(
+        "--cache-codec",
+        choices=["identity", "gzip", "zlib", "lzma"],
+        default="gzip",
+        help="Compression of SVG images in the disk cache. With gzip, SVG responses to clients that accept gzip are sent without recompressing",
+    )
+
+    parser.add_argument(
+        "--cache-readers",
+        type=int,
+        default=4,
+        help="Number of threads that read from the disk cache",
+    )
+
+    parser.add_argument(
+        "--memory-cache-bytes",
+        type=int,
+        default=2**26,
+        help="Maximum size in bytes of the in-memory cache of solutions, which is checked before the disk cache. If 0, disable it",
+    )
+
+    parser.add_argument(
+        "--compress-min-bytes",
+        type=int,
+        default=1024,
+        help="Smallest response body to compress, in bytes, for clients that accept gzip, deflate or (if the brotli package is installed) br",
+    )
+
+    parser.add_argument(
+        "--compress-cache-bytes",
+        type=int,
+        default=2**26,
+        help="Maximum size in bytes of the in-memory cache of compressed response bodies, keyed by ETag",
+    )
+
+    parser.add_argument(
+        "--bench-min-size",
+        type=int,
+        default=4,
+        help="Smallest number of pregenerated random instances to keep ready for /random",
+    )
+
+    parser.add_argument(
+        "--bench-max-size",
+        type=int,
+        default=256,
+        help="Largest number of pregenerated random instances to keep ready for /random. Between the two, the number follows the demand over the last ten seconds",
+    )
+
+    parser.add_argument(
+        "--snapshot-interval",
+        type=float,
+        default=300.0,
+        help="Seconds between snapshots of the bench and the hottest cache keys, which are reloaded on startup. A snapshot is also taken on shutdown",
+    )
+
+    parser.add_argument(
+        "--page-cache-bytes",
+        type=int,
+        default=2**26,
+        help="Maximum size in bytes of the in-memory cache of HTML pages of cached solutions",
+    )
+
+    parser.add_argument(
+        "--stream-svg-bytes",
+        type=int,
+        default=2**20,
+        help="Size in bytes of SVG images above which HTML pages are streamed around the image rather than built whole",
+    )
+
     res = parser.parse_args()
+    if res.max_columns < 2:
+        # Envelopes draw each bucket of heights as two columns
+        parser.error("--max-columns must be at least 2")
     if res.prefix.endswith("/"):
         warnings.warn("--prefix should probably not end with a slash")
 
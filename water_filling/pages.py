@@ -0,0 +1,52 @@
+"""Caching and streaming of rendered response bodies."""
+
+import threading
+from collections import OrderedDict
+
+# Stands in for the SVG when a page is rendered to be streamed around it
+svg_sentinel = "<!-- svg -->"
+
+
+class BodyCache:
+    """Thread-safe LRU cache of response bodies, bounded by their size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def get(self, key):
+        with self._lock:
+            if (body := self._bodies.get(key)) is not None:
+                self._bodies.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if (old := self._bodies.pop(key, None)) is not None:
+                self.nbytes -= len(old)
+            self._bodies[key] = body
+            self.nbytes += len(body)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._bodies.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+
+def split(page):
+    """Split a page rendered with `svg_sentinel` into the parts around the SVG."""
+    head, tail = page.split(svg_sentinel, 1)
+    return head, tail
+
+
+async def stream(head, svg_data, tail, chunk_size=2**16):
+    """Yield the page with `svg_data` between `head` and `tail`, in pieces."""
+    yield head.encode()
+    for start in range(0, len(svg_data), chunk_size):
+        yield svg_data[start : start + chunk_size].encode()
+    yield tail.encode()
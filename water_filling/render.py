@@ -0,0 +1,69 @@
+"""SVG rendering, optionally offloaded to a pool of worker processes."""
+
+import asyncio
+import importlib
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache
+
+from water_filling import svg
+from water_filling.options import get_options
+
+options = get_options()
+
+
+def initialize_worker():
+    """Select the SVG backend and import pyplot before the first render."""
+    if options.renderer == "matplotlib":
+        importlib.import_module("matplotlib").use("svg")
+        importlib.import_module("matplotlib.pyplot")
+
+
+def render_svg(heights, level):
+    """Render the water level with a given terrain as an SVG string.
+
+    Uses the backend selected by `--renderer`, drawing at most `--max-columns`
+    columns.
+    """
+    if options.renderer == "native":
+        return svg.render(heights, level, options.max_columns)
+    return render_svg_matplotlib(heights, level)
+
+
+def render_svg_matplotlib(heights, level):
+    """Render the water level using `visualize.visualize()`."""
+    # Imported here so that pyplot is never loaded with the native renderer
+    import matplotlib
+
+    from water_filling.visualize import visualize
+
+    matplotlib.use("svg")  # Allows starting in non-main thread
+    fig, ax = visualize(heights, level, options.max_columns)
+    with io.StringIO() as buf:
+        fig.savefig(buf, format="svg", transparent=True, bbox_inches="tight")
+        return buf.getvalue()
+
+
+@cache
+def get_executor():
+    """Process pool for rendering, or `None` if `--render-workers` is zero."""
+    if not options.render_workers:
+        return None
+    return ProcessPoolExecutor(
+        options.render_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initialize_worker,
+    )
+
+
+async def render_svg_async(heights, level):
+    """Like `render_svg()`, but run in the process pool if there is one.
+
+    This keeps the event loop free to serve other requests while the figure is
+    built and serialized.
+    """
+    if (executor := get_executor()) is None:
+        return render_svg(heights, level)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, render_svg, heights, level)
@@ -1,6 +1,10 @@
 """Helper functions for getting data in and out of strings."""
 
 import functools
+import io
+import json
+import re
+import tokenize
 from urllib.parse import quote
 
 import numpy as np
@@ -10,41 +14,164 @@ from water_filling.options import get_options
 options = get_options()
 
 
+# Characters that may appear in the comma-separated format. Checking these up
+# front keeps `np.loadtxt()` from seeing comments or line breaks.
+_number_chars = re.compile(r"[0-9eE+\-., \t]*")
+
+# Dtypes accepted for heights in binary request bodies, and what they become
+binary_dtypes = {"float64": np.float64, "int64": np.int64}
+
+
+def parse_numbers(s):
+    """Strictly parse a comma-separated list of numbers into an array.
+
+    The numbers are floats if there is a `.` or an exponent anywhere in `s`,
+    integers otherwise. Whitespace around the numbers and a trailing comma are allowed,
+    but anything else that is not a number makes this raise `ValueError`,
+    unlike `np.fromstring()`, which stops parsing at the first bad number.
+    """
+    if not _number_chars.fullmatch(s):
+        raise ValueError("Not a comma-separated list of numbers")
+    s = s.rstrip().removesuffix(",")
+    if not s:
+        raise ValueError("No numbers")
+    return np.loadtxt(
+        [s],
+        dtype=np.float64 if any(c in s for c in ".eE") else np.int_,
+        delimiter=",",
+        comments=None,
+        ndmin=1,
+    )
+
+
 @functools.lru_cache(maxsize=1024)
 def parse_volume(s):
     try:
-        if "." in s:
-            arr = np.fromstring(s, sep=",", dtype=np.float64)
-        else:
-            arr = np.fromstring(s, sep=",", dtype=np.int_)
+        arr = parse_numbers(s)
         if not arr.size == 1:
             raise ValueError
         res = arr[0]
         if not (0 <= res < np.inf):
             raise ValueError
         return res
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
 
 @functools.lru_cache(maxsize=1024)
 def parse_heights(s):
     try:
-        if "." in s:
-            res = np.fromstring(s, sep=",", dtype=np.float64)
-        else:
-            res = np.fromstring(s, sep=",", dtype=np.int_)
-        if not res.ndim == 1:
-            raise ValueError
-        if not 0 < res.size < 2**16:
-            raise ValueError
-        if not np.isfinite(res).all():
-            raise ValueError
-        return res
-    except ValueError:
+        return validate_heights(parse_numbers(s))
+    except (TypeError, ValueError):
         return None
 
 
+def validate_heights(arr):
+    """Check that `arr` holds valid heights, or return `None`.
+
+    Valid heights are a one-dimensional array of fewer than 2**16 finite
+    numbers, which is returned with a native-endian dtype.
+    """
+    if arr.ndim != 1:
+        return None
+    if not 0 < arr.size < 2**16:
+        return None
+    if not np.isfinite(arr).all():
+        return None
+    return arr.astype(arr.dtype.newbyteorder("="), copy=False)
+
+
+def parse_heights_json(body):
+    """Parse heights from a JSON array of numbers, or return `None`."""
+    try:
+        return heights_from_list(json.loads(body))
+    except (ValueError, RecursionError):
+        # Deeply nested arrays exhaust the decoder's recursion limit
+        return None
+
+
+def heights_from_list(values):
+    """Convert a list of numbers decoded from JSON into heights, or `None`."""
+    if not isinstance(values, list) or not all(
+        type(x) is int or type(x) is float for x in values
+    ):
+        return None
+    any_float = any(type(x) is float for x in values)
+    try:
+        arr = np.array(values, dtype=np.float64 if any_float else np.int_)
+    except OverflowError:
+        return None
+    return validate_heights(arr)
+
+
+def volume_from_number(value):
+    """Convert a number decoded from JSON into a volume, or `None`."""
+    if type(value) is int:
+        try:
+            res = np.int_(value)
+        except OverflowError:
+            return None
+    elif type(value) is float:
+        res = np.float64(value)
+    else:
+        return None
+    if not (0 <= res < np.inf):
+        return None
+    return res
+
+
+def parse_problem(obj):
+    """Convert a problem decoded from JSON into `(heights, volume)`, or `None`.
+
+    The problem must look like `{"heights": [1, 2, 3], "volume": 2}`.
+    """
+    if not isinstance(obj, dict):
+        return None
+    heights = heights_from_list(obj.get("heights"))
+    volume = volume_from_number(obj.get("volume"))
+    if heights is None or volume is None:
+        return None
+    return heights, volume
+
+
+def parse_heights_binary(body, dtype="float64"):
+    """Parse heights from raw little-endian numbers of `dtype`, or return `None`.
+
+    `dtype` is a key of `binary_dtypes`. The array is a zero-copy view of
+    `body`.
+    """
+    if (dtype := binary_dtypes.get(dtype)) is None:
+        return None
+    dtype = np.dtype(dtype).newbyteorder("<")
+    if len(body) % dtype.itemsize:
+        return None
+    return validate_heights(np.frombuffer(body, dtype=dtype))
+
+
+def parse_heights_npy(body):
+    """Parse heights from the contents of a `.npy` file, or return `None`.
+
+    Only arrays of the `binary_dtypes` are accepted. The array is a zero-copy
+    view of `body` when it is little-endian.
+    """
+    read_array_header = {
+        (1, 0): np.lib.format.read_array_header_1_0,
+        (2, 0): np.lib.format.read_array_header_2_0,
+    }
+    stream = io.BytesIO(body)
+    try:
+        version = np.lib.format.read_magic(stream)
+        shape, _, dtype = read_array_header[version](stream)
+    except (KeyError, ValueError, SyntaxError, tokenize.TokenError):
+        # The header is a Python literal, which can be broken in many ways
+        return None
+    if dtype.base.type not in binary_dtypes.values() or len(shape) != 1:
+        return None
+    if len(body) - stream.tell() != shape[0] * dtype.itemsize:
+        return None
+    return validate_heights(np.frombuffer(body, dtype=dtype, offset=stream.tell()))
+
+
 def to_str(vec_or_scalar):
     """Convert numbers to a string representation.
 
@@ -92,12 +219,15 @@ def to_english(vec_or_scalar):
 
 
 def to_json_serializable_dict(heights, volume, level, svg_data):
-    """Format given problem and solution as a JSON-serializable dict."""
+    """Format given problem and solution as a JSON-serializable dict.
+
+    `svg_data` may be `None` if the SVG was not needed.
+    """
     assert isinstance(heights, np.ndarray)
     assert isinstance(volume, np.floating) or isinstance(volume, np.integer)
     # Narrower type because we know this was returned from our function
     assert isinstance(level, np.float64)
-    assert isinstance(svg_data, str)
+    assert svg_data is None or isinstance(svg_data, str)
 
     return {
         "heights": heights.tolist(),
@@ -115,13 +245,13 @@ def to_json_serializable_dict(heights, volume, level, svg_data):
     }
 
 
-def filtered(response_dict):
+def filtered(response_dict, include_svg=False):
     """Filter output of `to_json_serializable_dict()`.
 
-    Leave only the keys that would be useful to a programmatic client.
+    Leave only the keys that would be useful to a programmatic client. The SVG
+    is large, so it is left out unless `include_svg` is true.
     """
-    return {
-        k: v
-        for k, v in response_dict.items()
-        if k in ["heights", "volume", "level", "svg", "permalink", "cached", "bench"]
-    }
+    keys = ["heights", "volume", "level", "permalink", "cached", "bench"]
+    if include_svg:
+        keys.append("svg")
+    return {k: v for k, v in response_dict.items() if k in keys}
@@ -0,0 +1,77 @@
+"""Snapshots of the in-process state, so that a restarted server starts warm.
+
+A snapshot holds the pregenerated `/random` responses of the bench and the keys
+of the solutions in the memory cache, as JSON. The solutions themselves are
+reloaded from the disk cache.
+"""
+
+import json
+import os
+
+from water_filling import database
+
+snapshot_path = database.cache_path.with_name("water_filling.snapshot.json")
+
+
+def state(bench, version):
+    """The state to snapshot, as a JSON-serializable dict.
+
+    `version` identifies the templates the bench entries were rendered with.
+    """
+    return {
+        "version": version,
+        "bench": list(bench.entries),
+        "hot_keys": [key.hex() for key in database.memory.recent_keys()],
+    }
+
+
+def save(state, path=snapshot_path):
+    """Write `state` to `path`, replacing any previous snapshot atomically."""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def load(bench, version, variants, path=snapshot_path):
+    """Restore the state saved at `path` into `bench` and the memory cache.
+
+    Bench entries rendered with other templates than those of `version` are
+    dropped. Each entry must have a body for each of `variants`, and nothing
+    else. Returns whether there was a snapshot to load; a malformed one is
+    ignored like a missing one.
+    """
+    try:
+        with open(path, "rb") as f:
+            state = json.load(f)
+        entries, hot_keys = validate(state, variants)
+    except (FileNotFoundError, ValueError):
+        return False
+    if state["version"] == version:
+        bench.entries.extend(entries[: bench.max_size])
+    database.warm_memory(hot_keys)
+    return True
+
+
+def validate(state, variants):
+    """The bench entries and hot keys of `state`, as loaded from JSON.
+
+    Raises `ValueError` if `state` does not look like the result of `state()`
+    for a bench of entries with bodies for `variants`.
+    """
+    variants = set(variants)
+    if not (
+        isinstance(state, dict)
+        and isinstance(state.get("version"), str)
+        and isinstance(entries := state.get("bench"), list)
+        and isinstance(hot_keys := state.get("hot_keys"), list)
+        and all(
+            isinstance(entry, dict)
+            and entry.keys() == variants
+            and all(isinstance(body, str) for body in entry.values())
+            for entry in entries
+        )
+        and all(isinstance(key, str) for key in hot_keys)
+    ):
+        raise ValueError("Malformed snapshot")
+    return entries, [bytes.fromhex(key) for key in hot_keys]
@@ -0,0 +1,128 @@
+"""Direct SVG rendering of the water level, without matplotlib.
+
+Produces a picture resembling the one from `visualize.visualize()`, but writes
+the SVG markup directly: the whole terrain is a single `<path>` whose commands
+are formatted with NumPy string operations, so the cost grows gently with the
+number of heights and pyplot is never imported.
+"""
+
+import hashlib
+
+import numpy as np
+
+from water_filling import colors, lod
+
+width, height = 640, 480
+margin_left, margin_right, margin_top, margin_bottom = 48, 8, 8, 8
+
+
+def render(heights, level, max_columns=None):
+    """Render the water level with a given terrain as an SVG string.
+
+    If `max_columns` is given, draw at most that many columns using
+    `lod.envelope()`.
+    """
+    heights = np.asanyarray(heights, dtype=np.float64)
+    level = float(level)
+    n = heights.size
+
+    # Same data limits as in `visualize.visualize()`
+    hmax = max(heights.max(), level)
+    hmin = heights.min()
+    if np.isclose(hrange := hmax - hmin, 0.0):
+        hmax += 0.5
+        hmin -= 0.5
+        hrange = hmax - hmin
+    ylo, yhi = hmin - 0.1 * hrange, hmax + 0.1 * hrange
+
+    # Affine maps from data to SVG coordinates
+    left, right = margin_left, width - margin_right
+    top, bottom = margin_top, height - margin_bottom
+    x_scale = (right - left) / n
+    y_scale = (bottom - top) / (yhi - ylo)
+
+    def to_x(x):
+        return left + (np.asanyarray(x) + 0.5) * x_scale
+
+    def to_y(y):
+        return top + (yhi - np.asanyarray(y)) * y_scale
+
+    # Deterministic, but distinct between pictures inlined in the same page
+    digest = hashlib.blake2b(heights.tobytes(), digest_size=4)
+    digest.update(np.float64(level).tobytes())
+    ids = f"wf{digest.hexdigest()}"
+
+    # Water surface: same triangle wave as `visualize.waveform == "triangle"`
+    xs = np.linspace(-0.5, n - 0.5, 12)
+    ys = level + 0.01 * hrange * np.power(-1, np.arange(xs.size))
+    water_points = " ".join(
+        np.char.add(
+            np.char.mod("%.2f,", to_x(xs)),
+            np.char.mod("%.2f", to_y(ys)),
+        )
+    )
+    water_points += f" {right:.2f},{bottom:.2f} {left:.2f},{bottom:.2f}"
+
+    # Terrain: a skyline along the tops of the columns, plus zero-area subpaths
+    # for the dividers between neighboring columns
+    if max_columns is None:
+        edges, tops = np.arange(n + 1) - 0.5, heights
+    else:
+        edges, tops = lod.envelope(heights, max_columns)
+    edges, tops = to_x(edges), to_y(tops)
+    skyline = "".join(
+        np.char.add(
+            np.char.mod("V%.2f", tops),
+            np.char.mod("H%.2f", edges[1:]),
+        )
+    )
+    dividers = "".join(
+        np.char.add(
+            np.char.mod("M%.2f", edges[1:-1]),
+            np.char.mod(f",{bottom:.2f}V%.2f", np.maximum(tops[:-1], tops[1:])),
+        )
+    )
+    terrain = f"M{left:.2f},{bottom:.2f}{skyline}V{bottom:.2f}Z{dividers}"
+
+    # Vertical axis with round-number ticks
+    ticks = _ticks(ylo, yhi)
+    tick_ys = to_y(ticks)
+    tick_marks = "".join(
+        np.char.mod(f"M{left - 4:.2f},%.2fh4", tick_ys),
+    )
+    tick_labels = "".join(
+        np.char.add(
+            np.char.mod(f'<text x="{left - 6:.2f}" y="%.2f">', tick_ys),
+            np.char.add(np.char.mod("%g", ticks), "</text>"),
+        )
+    )
+
+    gray = colors.colors["gray"]
+    return f"""\
+<?xml version="1.0" encoding="utf-8" standalone="no"?>
+<svg xmlns="http://www.w3.org/2000/svg" version="1.1" width="{width}" height="{height}" viewBox="0 0 {width} {height}">
+ <defs>
+  <clipPath id="{ids}-clip"><rect x="{left}" y="{top}" width="{right - left}" height="{bottom - top}"/></clipPath>
+  <pattern id="{ids}-hatch" patternUnits="userSpaceOnUse" width="8" height="8">
+   <path d="M0,0L8,8M8,0L0,8" stroke="{gray}" stroke-width="0.75"/>
+  </pattern>
+ </defs>
+ <g clip-path="url(#{ids}-clip)" stroke="{gray}" stroke-linejoin="miter">
+  <polygon points="{water_points}" fill="{colors.colors["water"]}"/>
+  <path d="{terrain}" fill="{colors.colors["terrain"]}"/>
+  <path d="{terrain}" fill="url(#{ids}-hatch)" stroke="none"/>
+ </g>
+ <path d="M{left:.2f},{top:.2f}V{bottom:.2f}{tick_marks}" stroke="{gray}" fill="none"/>
+ <g font-family="sans-serif" font-size="10" fill="{gray}" text-anchor="end" dominant-baseline="middle">{tick_labels}</g>
+</svg>
+"""
+
+
+def _ticks(lo, hi, target=6):
+    """Round-numbered ticks between `lo` and `hi`, about `target` of them."""
+    raw_step = (hi - lo) / target
+    magnitude = 10 ** np.floor(np.log10(raw_step))
+    for multiple in [1, 2, 2.5, 5, 10]:
+        if (step := multiple * magnitude) >= raw_step:
+            break
+    return np.arange(np.ceil(lo / step), np.floor(hi / step) + 1) * step
@@ -3,13 +3,17 @@
 import matplotlib.pyplot as plt
 import numpy as np
 
-from water_filling import colors
+from water_filling import colors, lod
 
 waveform = "triangle"
 
 
-def visualize(heights, level):
-    """Visualize the water level with a given terrain."""
+def visualize(heights, level, max_columns=None):
+    """Visualize the water level with a given terrain.
+
+    If `max_columns` is given, draw at most that many columns using
+    `lod.envelope()`.
+    """
     heights = np.asanyarray(heights)
     fig, ax = plt.subplots()
 
@@ -46,11 +50,16 @@ def visualize(heights, level):
         fc=colors.colors["water"],
         edgecolor=colors.colors["gray"],
     )
+    if max_columns is None:
+        edges, tops = np.arange(heights.size + 1) - 0.5, heights
+    else:
+        edges, tops = lod.envelope(heights, max_columns)
     ax.bar(
-        np.arange(heights.size),
-        heights - baseline,
+        edges[:-1],
+        tops - baseline,
         bottom=baseline,
-        width=1.0,
+        width=np.diff(edges),
+        align="edge",
         hatch="x",
         fc=colors.colors["terrain"],
         edgecolor=colors.colors["gray"],